@@ -17,41 +17,293 @@
 #
 
 from twisted.web.http import HTTPChannel, HTTPFactory
-from ConnectRequest import ConnectRequest
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.task import LoopingCall
+from twisted.internet import reactor
+from zope.interface import implementer
+from ConnectRequest import ConnectRequest, NotaryStats, ResolverCache
 
-import logging
+from convergence.pages import TaggedLogger
+from convergence import metrics
+
+from collections import defaultdict
+import time, socket, logging
 
 log = logging.getLogger(__name__)
 
+metric_bytes = metrics.counter( 'proxy_tunnel_bytes_total',
+    'Bytes relayed through proxy tunnels (up - from client, down - from notary).', ['direction'] )
+metric_pauses = metrics.counter( 'proxy_tunnel_pauses_total',
+    'Number of times reading from one side of proxy tunnel'
+        ' was paused until the other side catches up.', ['direction'] )
+metric_tunnels = metrics.counter( 'proxy_tunnels_total',
+    'Proxy tunnels established to destination notaries.' )
+metric_rejected = metrics.counter( 'proxy_rejected_total',
+    'Proxy connections rejected due to connection limits.', ['limit'] )
+metric_reaped = metrics.counter( 'proxy_reaped_total',
+    'Proxy connections closed due to timeouts.', ['reason'] )
+
+
+class TimerWheel(object):
+    '''Coarse-grained timer for deadlines of a large number of
+        objects (connections), bucketed into slots of "resolution" seconds.
+        All of them are handled by a single LoopingCall, calling
+        wheelExpired() method of the object on its deadline.'''
+
+    def __init__(self, resolution=1.0):
+        self.resolution, self.slots = resolution, defaultdict(set)
+        self.tick, self.loop = None, LoopingCall(self._tick)
+
+    def _slot(self, ts): return int(ts / self.resolution)
+
+    def start(self):
+        self.tick = self._slot(reactor.seconds())
+        self.loop.start(self.resolution, now=False)
+
+    def stop(self):
+        if self.loop.running: self.loop.stop()
+
+    def schedule(self, obj, delay):
+        self.cancel(obj)
+        obj._wheel_slot = max(self.tick, self._slot(reactor.seconds() + delay))
+        self.slots[obj._wheel_slot].add(obj)
+
+    def cancel(self, obj):
+        slot = getattr(obj, '_wheel_slot', None)
+        if slot is None: return
+        objs = self.slots.get(slot)
+        if objs is not None:
+            objs.discard(obj)
+            if not objs: del self.slots[slot]
+        obj._wheel_slot = None
+
+    def _tick(self):
+        slot_now = self._slot(reactor.seconds())
+        while self.tick <= slot_now:
+            objs = self.slots.pop(self.tick, None)
+            self.tick += 1
+            if not objs: continue
+            for obj in objs:
+                obj._wheel_slot = None
+                try: obj.wheelExpired()
+                except Exception: log.exception('Error processing timer for %r', obj)
+
+
+# Tunnels register each side's transport as a streaming producer for the other one,
+#  so that reading from e.g. client gets paused when notary connection write-buffer
+#  goes over the high-water mark (transport.bufferSize), resuming when it's flushed.
+
+@implementer(IPushProducer)
+class RelayProducer(object):
+
+    def __init__(self, transport, direction, stats):
+        self.transport, self.direction, self.stats = transport, direction, stats
+        self.paused = None
+
+    def pauseProducing(self):
+        if self.paused is None:
+            self.paused = time.time()
+            self.stats.pauses[self.direction] += 1
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        if self.paused is not None:
+            self.stats.paused_time[self.direction] += time.time() - self.paused
+            self.paused = None
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        self.transport.stopProducing()
+
+
+class TunnelStats(object):
+
+    def __init__(self):
+        self.bytes, self.pauses, self.paused_time =\
+            (dict(up=0, down=0) for n in xrange(3))
+        self.producers, self.spliced = list(), None
+        self.started = time.time()
+
+    @property
+    def paused(self):
+        return any(p.paused is not None for p in self.producers)
+
+    @property
+    def relayed(self):
+        'Total number of bytes relayed so far.'
+        if self.spliced: return self.spliced.up.bytes + self.spliced.down.bytes
+        return self.bytes['up'] + self.bytes['down']
+
+    def __str__(self):
+        if self.spliced: return '{0[up]} B up / {0[down]} B down, spliced'.format(self.bytes)
+        return ( '{0[up]} B up / {0[down]} B down, paused reading'
+            ' client {1[up]} time(s) ({2[up]:.1f}s), notary {1[down]} time(s) ({2[down]:.1f}s)' )\
+            .format(self.bytes, self.pauses, self.paused_time)
+
 
 # The HTTPChannel for incoming CONNECT requests to other notaries.
 
 class ConnectChannel(HTTPChannel):
 
     def __init__(self, log):
-        self.log, self.proxyConnection = log, None
+        self.log, self.proxyConnection, self.tunnel = log, None, None
+        self.relayed_last = None
         HTTPChannel.__init__(self)
 
+    def connectionMade(self):
+        HTTPChannel.connectionMade(self)
+        self.factory.wheel.schedule(self, self.factory.timeOut)
+
+    def wheelExpired(self):
+        'Timer wheel callback for setup timeout, idle timeout or max tunnel lifetime.'
+        if self.tunnel is None: reason = 'setup'
+        else:
+            factory, now = self.factory, time.time()
+            lifetime_left = factory.tunnel_lifetime and\
+                (self.tunnel.started + factory.tunnel_lifetime - now)
+            relayed = self.tunnel.relayed
+            if factory.tunnel_lifetime and lifetime_left <= 0: reason = 'lifetime'
+            elif factory.tunnel_idle and relayed == self.relayed_last: reason = 'idle'
+            else:
+                self.relayed_last = relayed
+                self.factory.wheel.schedule( self,
+                    min(filter(None, [factory.tunnel_idle, lifetime_left])) )
+                return
+        self.log.debug('Closing connection (timeout: %s)', reason)
+        metric_reaped.inc(reason)
+        if self.tunnel and self.tunnel.spliced:
+            # Splice relay will notice these and close the tunnel from its side
+            for transport in self.transport, self.proxyConnection.transport:
+                try: transport.socket.shutdown(socket.SHUT_RDWR)
+                except socket.error: pass
+        else: self.transport.abortConnection()
+
     def requestFactory(self, *args, **kws):
         kws['log'] = self.log
         return ConnectRequest(*args, **kws)
 
+    def startTunnel(self, proxyConnection, response):
+        'Send response to client and switch to relaying raw data between it and proxyConnection.'
+        self.proxyConnection, self.tunnel = proxyConnection, TunnelStats()
+        self.setRawMode()
+        self.factory.tunnels.add(self)
+        metric_tunnels.inc()
+        self.relayed_last = 0
+        if self.factory.tunnel_idle or self.factory.tunnel_lifetime:
+            self.factory.wheel.schedule(self, min(filter( None,
+                [self.factory.tunnel_idle, self.factory.tunnel_lifetime] )))
+        else: self.factory.wheel.cancel(self)
+        if self.factory.splice_relay: return self.spliceTunnel(response)
+
+        client, notary = self.transport, proxyConnection.transport
+        for transport, producer in [
+                (notary, RelayProducer(client, 'up', self.tunnel)),
+                (client, RelayProducer(notary, 'down', self.tunnel)) ]:
+            if transport.producer is not None: transport.unregisterProducer()
+            if self.factory.tunnel_buffer: transport.bufferSize = self.factory.tunnel_buffer
+            transport.registerProducer(producer, True)
+            self.tunnel.producers.append(producer)
+        # Newer HTTPChannel pauses reading while request is being processed
+        client.resumeProducing()
+        client.write(response)
+
+    def spliceTunnel(self, response):
+        'Hand both sockets over to splice relay, which does not pass any data through python.'
+        self.log.debug('Passing tunnel to splice relay')
+        # Data that client might've sent right after the request, same as what setRawMode passes on
+        leftover = ''
+        for k in '_buffer', '_LineReceiver__buffer': # newer/older twisted
+            if getattr(self, k, None):
+                leftover += getattr(self, k)
+                setattr(self, k, '')
+        self.setTimeout(None)
+        client, notary = self.transport, self.proxyConnection.transport
+        for transport in client, notary:
+            transport.stopReading()
+            transport.stopWriting()
+        self.tunnel.spliced = self.factory.splice_relay.relay( client.socket,
+            notary.socket, self.spliceDone, prefix_up=leftover, prefix_down=response )
+
+    def spliceDone(self, bytes_up, bytes_down, err):
+        self.tunnel.bytes.update(up=bytes_up, down=bytes_down)
+        if err: self.log.debug('Splice relay error: %s', err)
+        self.transport.loseConnection()
+
     def rawDataReceived(self, data):
-        self.log.debug('Shuffling raw data (%s bytes)', len(data))
+        self.tunnel.bytes['up'] += len(data)
         self.proxyConnection.transport.write(data)
 
     def connectionLost(self, reason):
         self.log.debug('Connection lost from client: %s', reason)
+        self.factory.channelClosed(self)
         if (self.proxyConnection is not None):
             self.proxyConnection.transport.loseConnection()
+        if self.tunnel is not None:
+            self.log.debug('Tunnel stats: %s', self.tunnel)
+            for direction, value in self.tunnel.bytes.viewitems():
+                metric_bytes.add(value, direction)
+            for direction, value in self.tunnel.pauses.viewitems():
+                metric_pauses.add(value, direction)
 
         HTTPChannel.connectionLost(self, reason)
 
 class ConnectChannelFactory(HTTPFactory):
 
+        def __init__(self, *args, **kws):
+            self.tunnel_buffer = kws.pop('tunnel_buffer', None)
+            self.splice_relay = kws.pop('splice_relay', None)
+            self.connect_stagger = kws.pop('connect_stagger', 0.25)
+            self.max_connections = kws.pop('max_connections', None)
+            self.max_client_connections = kws.pop('max_client_connections', None)
+            self.tunnel_idle = kws.pop('tunnel_idle', None)
+            self.tunnel_lifetime = kws.pop('tunnel_lifetime', None)
+            resolver_ttl = kws.pop('resolver_ttl', None)
+            self.resolver = ResolverCache(resolver_ttl) if resolver_ttl else None
+            self.notary_stats = NotaryStats()
+            HTTPFactory.__init__(self, *args, **kws)
+
+            # All timeouts are handled by the wheel instead of per-connection callLater
+            self.wheel = TimerWheel()
+            self.channels, self.tunnels, self.clients = set(), set(), defaultdict(int)
+            metrics.gauge( 'proxy_connections',
+                'Open client connections to proxy port.', func=lambda: len(self.channels) )
+            metrics.gauge( 'proxy_tunnels',
+                'Established proxy tunnels.', func=lambda: len(self.tunnels) )
+            metrics.gauge( 'proxy_tunnels_paused',
+                'Proxy tunnels with reading from either side paused.',
+                func=lambda: sum(1 for t in self.tunnels if t.tunnel.paused) )
+
+        def startFactory(self):
+            HTTPFactory.startFactory(self)
+            self.wheel.start()
+
+        def stopFactory(self):
+            self.wheel.stop()
+            HTTPFactory.stopFactory(self)
+
         def buildProtocol(self, addr):
-            log = TaggedLogger(log)
-            log.debug('New ConnectChannel for client: %s', addr)
-            p = self.ConnectChannel(log)
-            p.factory, p.timeOut = self, self.timeOut
+            if self.max_connections and len(self.channels) >= self.max_connections:
+                log.debug('Rejecting connection from %s: max connections limit reached', addr)
+                metric_rejected.inc('total')
+                return None
+            if self.max_client_connections\
+                    and self.clients[addr.host] >= self.max_client_connections:
+                log.debug('Rejecting connection from %s: max per-client connections limit reached', addr)
+                metric_rejected.inc('client')
+                return None
+
+            tagged = TaggedLogger(log)
+            tagged.debug('New ConnectChannel for client: %s', addr)
+            p = ConnectChannel(tagged)
+            p.factory, p.timeOut, p.client_host = self, None, addr.host
+            self.channels.add(p)
+            self.clients[addr.host] += 1
             return p
+
+        def channelClosed(self, channel):
+            self.wheel.cancel(channel)
+            self.tunnels.discard(channel)
+            if channel in self.channels:
+                self.channels.remove(channel)
+                self.clients[channel.client_host] -= 1
+                if not self.clients[channel.client_host]: del self.clients[channel.client_host]
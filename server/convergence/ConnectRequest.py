@@ -17,13 +17,107 @@
 #
 
 from twisted.internet.protocol import BaseProtocol, ClientFactory
-from twisted.internet import reactor
+from twisted.internet.abstract import isIPAddress
+from twisted.internet import reactor, defer
 from twisted.web import http
+from twisted.python.failure import Failure
 
-import re, logging
+from convergence import metrics
+
+from collections import OrderedDict
+import re, time, logging
 
 log = logging.getLogger(__name__)
 
+metric_attempts = metrics.counter( 'proxy_connect_attempts_total',
+    'Connection attempts to destination notaries'
+        ' (cancelled - when other destination connected first).', ['result'] )
+metric_resolver_cache = metrics.counter( 'proxy_resolver_cache_total',
+    'Destination notary hostname lookups in resolver cache.', ['result'] )
+metric_resolver_lookups = metrics.counter( 'proxy_resolver_lookups_total',
+    'Destination notary hostname resolver queries.', ['result'] )
+metric_resolver_time = metrics.counter( 'proxy_resolver_seconds_total',
+    'Total time spent waiting for resolver queries for destination notary hostnames.' )
+
+
+class ResolverCache(object):
+    '''Cache of resolved addresses for destination notaries with a fixed TTL.
+        Entries that are used after "refresh" fraction of TTL are re-resolved in background,
+        so that frequently-used ones never have to wait for resolver.'''
+
+    def __init__(self, ttl, refresh=0.5, max_hosts=1024):
+        self.ttl, self.refresh, self.max_hosts = ttl, refresh, max_hosts
+        self.entries = OrderedDict() # host -> (address, ts_resolved)
+        self.lookups = dict() # host -> list of deferreds waiting for result
+
+    def resolve(self, host):
+        if isIPAddress(host): return defer.succeed(host)
+        entry = self.entries.get(host)
+        if entry:
+            address, ts = entry
+            age = time.time() - ts
+            if age < self.ttl:
+                metric_resolver_cache.inc('hit')
+                if age > self.ttl * self.refresh and host not in self.lookups:
+                    self.lookup(host).addErrback(lambda err: None)
+                return defer.succeed(address)
+        metric_resolver_cache.inc('miss')
+        return self.lookup(host)
+
+    def lookup(self, host):
+        deferred = defer.Deferred()
+        if host in self.lookups:
+            self.lookups[host].append(deferred)
+            return deferred
+        self.lookups[host] = [deferred]
+
+        ts = time.time()
+        def _done(result):
+            metric_resolver_time.add(time.time() - ts)
+            if isinstance(result, Failure):
+                metric_resolver_lookups.inc('error')
+                log.debug('Failed to resolve %r: %s', host, result.getErrorMessage())
+            else:
+                metric_resolver_lookups.inc('ok')
+                self.entries.pop(host, None)
+                self.entries[host] = result, time.time()
+                while len(self.entries) > self.max_hosts: self.entries.popitem(last=False)
+            for deferred in self.lookups.pop(host):
+                if isinstance(result, Failure): deferred.errback(result)
+                else: deferred.callback(result)
+        reactor.resolve(host).addBoth(_done)
+
+        return deferred
+
+
+class NotaryStats(object):
+    '''Moving estimates of TCP connection time and failure
+        rate for destination notaries, used to rank these for connection.'''
+
+    alpha, rtt_default, failure_penalty = 0.3, 0.1, 4.0
+
+    def __init__(self, max_hosts=1024):
+        self.hosts, self.max_hosts = OrderedDict(), max_hosts # host -> [rtt, failure_rate]
+
+    def _update(self, host, rtt, failed):
+        stats = self.hosts.pop(host, None)
+        if stats is None: stats = [self.rtt_default if rtt is None else rtt, float(failed)]
+        else:
+            if rtt is not None: stats[0] += self.alpha * (rtt - stats[0])
+            stats[1] += self.alpha * (failed - stats[1])
+        self.hosts[host] = stats
+        while len(self.hosts) > self.max_hosts: self.hosts.popitem(last=False)
+
+    def success(self, host, rtt): self._update(host, rtt, False)
+    def failure(self, host): self._update(host, None, True)
+
+    def score(self, host):
+        rtt, failure_rate = self.hosts.get(host) or (self.rtt_default, 0)
+        return rtt * (1 + self.failure_penalty * failure_rate)
+
+    def rank(self, hosts):
+        return sorted(hosts, key=self.score)
+
 
 # This class is responsible for parsing incoming requests
 # on the HTTP port.  The only method it supports is CONNECT,
@@ -77,19 +171,23 @@ class ConnectRequest(http.Request):
             self.denyRequest()
 
     def proxyRequest(self, destinations):
-        factory = NotaryConnectionFactory(self, log=self.log)
-        factory.protocol = NotaryConnection
-
+        hosts = list()
         for destination in destinations:
             if (destination.find(':') != -1):
                 destination = destination.split(':')[0]
             elif (destination.find('+') != -1):
                 destination = destination.split('+')[0]
+            if destination not in hosts: hosts.append(destination)
 
-            self.log.debug('Connecting to: %s', destination)
+        channel_factory = self.channel.factory
+        hosts = channel_factory.notary_stats.rank(hosts)
+        self.log.debug('Destinations, by rank: %s', ', '.join(hosts))
 
-            connector = reactor.connectTCP(destination, 4242, factory)
-            factory.addConnector(connector, destination)
+        factory = NotaryConnectionFactory( self, hosts,
+            channel_factory.notary_stats, channel_factory.connect_stagger,
+            resolver=channel_factory.resolver, log=self.log )
+        factory.protocol = NotaryConnection
+        factory.connectNext()
 
     def denyRequest(self):
         self.setResponseCode(http.FORBIDDEN, 'Access Denied')
@@ -106,16 +204,17 @@ class NotaryConnection(BaseProtocol):
     def __init__(self, client, host, log=log):
         self.client = client
         self.host = host
+        self.log = log
 
     def connectionMade(self):
         self.log.debug('Connection made to notary: %s', self.host)
-        self.client.channel.proxyConnection = self
-        self.client.channel.setRawMode()
-        self.client.transport.write('HTTP/1.0 200 Connection Established\r\n')
-        self.client.transport.write('Proxy-Agent: Convergence\r\n')
-        self.client.transport.write('X-Convergence-Notary: {}\r\n\r\n'.format(self.host))
+        self.client.channel.startTunnel( self,
+            'HTTP/1.0 200 Connection Established\r\n'
+            'Proxy-Agent: Convergence\r\n'
+            'X-Convergence-Notary: {}\r\n\r\n'.format(self.host) )
 
     def dataReceived(self, data):
+        self.client.channel.tunnel.bytes['down'] += len(data)
         self.client.transport.write(data)
 
     def connectionLost(self, reason):
@@ -123,40 +222,87 @@ class NotaryConnection(BaseProtocol):
         self.client.transport.loseConnection()
 
 # The ConnectionFactory for a proxy tunnel to another notary.
+# Connections are started in the order of destination ranking,
+#  with next one started only on failure or after "stagger" delay,
+#  and whichever connects first gets used, cancelling the rest.
+
 class NotaryConnectionFactory(ClientFactory):
 
-    def __init__(self, client, log=log):
-        self.client = client
-        self.connectors = []
-        self.connectorHosts = {}
-        self.connectedConnector = None
+    def __init__(self, client, hosts, stats, stagger, resolver=None, log=log):
+        self.client, self.log = client, log
+        self.hosts, self.stats, self.stagger = list(hosts), stats, stagger
+        self.resolver, self.resolving = resolver, 0
+        self.connectors = dict() # connector -> (host, ts_started)
+        self.connectedConnector, self.staggerCall = None, None
+
+    def connectNext(self):
+        if self.staggerCall and self.staggerCall.active(): self.staggerCall.cancel()
+        self.staggerCall = None
+        if self.connectedConnector is not None\
+            or not self.hosts or self.client._disconnected: return
+
+        host = self.hosts.pop(0)
+        self.log.debug('Connecting to: %s', host)
+        if self.hosts: self.staggerCall = reactor.callLater(self.stagger, self.connectNext)
+        if self.resolver:
+            self.resolving += 1
+            self.resolver.resolve(host).addCallbacks(
+                self._connect, self._resolveFailed, callbackArgs=[host], errbackArgs=[host] )
+        else: self._connect(host, host)
+
+    def _connect(self, address, host):
+        if self.resolver: self.resolving -= 1
+        if self.connectedConnector is not None or self.client._disconnected: return
+        self.connectors[reactor.connectTCP(address, 4242, self)] = host, time.time()
+
+    def _resolveFailed(self, err, host):
+        self.resolving -= 1
+        self.log.debug('Failed to resolve notary hostname (%s): %s', host, err.getErrorMessage())
+        self._failed(host)
 
     def buildProtocol(self, addr):
-        if self.connectedConnector is None:
-            for connector in self.connectors[:]:
-                if connector.state == 'connected':
-                    self.connectedConnector = connector
-                else:
-                    self.connectors.remove(connector)
-                    del self.connectorHosts[connector]
-                    connector.disconnect()
-
-            host = self.connectorHosts[self.connectedConnector]
-            return NotaryConnection(self.client, host, log=self.log)
-
-    def addConnector(self, connector, host):
-        self.connectors.append(connector)
-        self.connectorHosts[connector] = host
+        if self.connectedConnector is not None: return None
+        if self.client._disconnected:
+            # Client is gone (e.g. reaped by setup timeout) while connects were pending
+            self.log.debug('Client disconnected before notary connection was established')
+            self.hosts = list()
+            if self.staggerCall and self.staggerCall.active(): self.staggerCall.cancel()
+            connectors, self.connectors = self.connectors, dict()
+            for connector in connectors:
+                metric_attempts.inc('cancelled')
+                if connector.state != 'connected': connector.disconnect()
+            return None # closes the one that connected
+        for connector in self.connectors:
+            if connector.state == 'connected':
+                self.connectedConnector = connector
+                break
+        else: return None
+
+        host, ts = self.connectors.pop(self.connectedConnector)
+        self.stats.success(host, time.time() - ts)
+        metric_attempts.inc('success')
+
+        if self.staggerCall and self.staggerCall.active(): self.staggerCall.cancel()
+        connectors, self.connectors = self.connectors, dict()
+        for connector in connectors:
+            metric_attempts.inc('cancelled')
+            connector.disconnect()
+
+        return NotaryConnection(self.client, host, log=self.log)
 
     def clientConnectionFailed(self, connector, reason):
-        if connector in self.connectors:
-            self.log.debug(
-                'Connection to notary (%s) failed: %s',
-                self.connectorHosts[connector], reason )
-            self.connectors.remove(connector)
-            del self.connectorHosts[connector]
-
-        if len(self.connectors) == 0:
+        if connector not in self.connectors: return # cancelled
+        host, ts = self.connectors.pop(connector)
+        self.log.debug('Connection to notary (%s) failed: %s', host, reason)
+        self._failed(host)
+
+    def _failed(self, host):
+        self.stats.failure(host)
+        metric_attempts.inc('failure')
+        if self.connectedConnector is not None or self.client._disconnected: return
+
+        if self.hosts: self.connectNext()
+        elif not self.connectors and not self.resolving:
             self.log.warning('Connection to notary failed!')
             self.client.setResponseCode(http.NOT_FOUND, 'Unable to connect')
             self.client.setHeader('Connection', 'close')
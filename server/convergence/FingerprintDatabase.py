@@ -16,16 +16,108 @@
 # USA
 #
 
-from twisted.internet import defer
-import time
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+
+from convergence.bloom import BloomFilter
+from convergence.schema import schema
+from convergence import metrics
+
+import time, logging
+
+log = logging.getLogger(__name__)
+
+metric_filter = metrics.counter( 'db_location_filter_total',
+    'Record lookups checked against in-memory filter of known locations, by whether'
+        ' these were skipped (location never seen), passed to db or turned out to'
+        ' be false positives (passed, but no records found).', ['result'] )
 
 
 # This class wraps access to the local database of seen target fingerprints.
+# Lookups ("hit" lane) can be done through a separate read-only connection pool,
+#  so that they never have to wait in the same queue with record updates ("miss" lane).
+# Optional bloom filter of known locations allows to skip lookups for never-seen
+#  ones, which is only correct if this is the only process adding records to database
+#  (or if filter gets rebuilt periodically, with some misses in-between being acceptable).
 
 class FingerprintDatabase:
 
-    def __init__(self, connection):
+    # Filter is sized for this many times the number of rows at the time it's built
+    filterGrowth = 2
+    filterMinCapacity = 10000
+
+    def __init__(self, connection, readConnection=None, filterErrorRate=None, filterRebuild=None):
         self.connection = connection
+        self.readConnection = readConnection or connection
+        self.queued = dict(hit=0, miss=0) # queries/interactions queued or running
+
+        self.locations, self.locationsAdded = None, None
+        self.filterErrorRate, self.filterRebuild = filterErrorRate, filterRebuild
+        if filterErrorRate:
+            metrics.gauge( 'db_location_filter_entries',
+                'Approximate number of distinct locations in the filter.',
+                func=lambda: len(self.locations) if self.locations is not None else 0 )
+            metrics.gauge( 'db_location_filter_bytes',
+                'Memory used by the location filter bit array.',
+                func=lambda: self.locations.size if self.locations is not None else 0 )
+            reactor.callWhenRunning(self.startLocationFilter)
+
+    def startLocationFilter(self):
+        if self.filterRebuild:
+            self.filterLoop = LoopingCall(self.rebuildLocationFilter)
+            self.filterLoop.start(self.filterRebuild, now=True)
+        else: self.rebuildLocationFilter()
+
+    def rebuildLocationFilter(self):
+        '''Builds new filter from locations in the database, replacing current one when done.
+            Lookups go to database as usual until filter is built for the first time.'''
+        if self.locationsAdded is not None:
+            log.debug('Location filter rebuild is already in progress, skipping')
+            return defer.succeed(None)
+        ts, self.locationsAdded = time.time(), set()
+        log.debug('Building location filter (error rate: %s)', self.filterErrorRate)
+
+        def _build(transaction):
+            transaction.execute('SELECT COUNT(*) FROM fingerprints')
+            rows = transaction.fetchone()[0]
+            locations = BloomFilter( max(self.filterMinCapacity,
+                rows * self.filterGrowth), self.filterErrorRate )
+            transaction.execute('SELECT location FROM fingerprints')
+            while True:
+                chunk = transaction.fetchmany(10000)
+                if not chunk: break
+                for location, in chunk: locations.add(location.encode('utf-8'))
+            return locations
+        def _done(locations):
+            # Anything added while filter was being built might be missing from it
+            for location in self.locationsAdded: locations.add(location)
+            self.locations, self.locationsAdded = locations, None
+            log.info( 'Built location filter in %.1fs: ~%s location(s), %.1f MiB',
+                time.time() - ts, len(locations), locations.size / 2.0**20 )
+        def _failed(err):
+            self.locationsAdded = None
+            log.error('Failed to build location filter: %s', err.getErrorMessage())
+
+        return self.readConnection.runInteraction(_build).addCallbacks(_done, _failed)
+
+    def _addLocation(self, location):
+        if self.locationsAdded is not None: self.locationsAdded.add(location)
+        if self.locations is not None:
+            self.locations.add(location)
+            if self.locations.full and self.locationsAdded is None:
+                log.info('Location filter reached its capacity, rebuilding it')
+                self.rebuildLocationFilter()
+
+    @property
+    def pending(self):
+        return sum(self.queued.viewvalues())
+
+    def _track(self, lane, deferred):
+        self.queued[lane] += 1
+        def _done(result):
+            self.queued[lane] -= 1
+            return result
+        return deferred.addBoth(_done)
 
     def _getLocation(self, host, port):
         return host+':'+str(port)
@@ -58,11 +150,25 @@ class FingerprintDatabase:
         return transaction.fetchall()
 
     def updateRecordsFor(self, host, port, fingerprint):
-        return self.connection.runInteraction(self._updateRecords, host, port, fingerprint)
+        # Added before the insert, so that filter never has false negatives
+        if self.filterErrorRate: self._addLocation(self._getLocation(host, port))
+        return self._track( 'miss',
+            self.connection.runInteraction(self._updateRecords, host, port, fingerprint) )
 
     def getRecordsFor(self, host, port):
         params = (self._getLocation(host, port),)
-        return self.connection.runQuery(
+        if self.locations is not None:
+            if params[0] not in self.locations:
+                metric_filter.inc('skipped')
+                return defer.succeed([])
+            metric_filter.inc('passed')
+        deferred = self._track('hit', self.readConnection.runQuery(
             'SELECT fingerprint, timestamp_start, timestamp_finish ' \
             'FROM fingerprints WHERE location = ? ' \
-            'ORDER BY timestamp_finish DESC', params);
+            'ORDER BY timestamp_finish DESC', params))
+        if self.locations is not None: deferred.addCallback(self._checkFiltered)
+        return deferred
+
+    def _checkFiltered(self, recordRows):
+        if not recordRows: metric_filter.inc('false_positive')
+        return recordRows
@@ -16,29 +16,61 @@
 # USA
 #
 
-import hashlib, json, base64, logging
-from M2Crypto import BIO, RSA
+from twisted.internet import defer
+
+from convergence import metrics
+
+import json, base64, time, logging
+
+metric_stage = metrics.histogram( 'target_stage_seconds',
+    'Time taken by each stage of target requests processing'
+        ' (db_lookup, verify, db_update, sign), including queueing.', ['stage'] )
 
 # This class is responsible for formatting verification response
 # data into JSON, and signing it.
+# Signers are tried in order, first one with the scheme that client
+#  accepts gets used, falling back to the last (default, rsa-sha1) one.
 
 class NotaryResponse:
 
-    def __init__(self, request, privateKey):
+    schemesHeader = 'X-Convergence-Signature-Schemes'
+
+    def __init__(self, request, signers):
         self.request = request
-        self.privateKey = privateKey
+        self.signers = signers
 
-    def signResponse(self, response):
-        digest = hashlib.sha1()
-        digest.update(json.dumps(response))
+    def getSigner(self):
+        accepted = self.request.getHeader(self.schemesHeader)
+        if accepted:
+            accepted = set(scheme.strip().lower() for scheme in accepted.split(','))
+            for signer in self.signers:
+                if signer.scheme in accepted: return signer
+        return self.signers[-1]
 
-        bio = BIO.MemoryBuffer(self.privateKey)
-        key = RSA.load_key_bio(bio)
-        signature = key.sign(digest.digest(), 'sha1')
+    def signResponse(self, response):
+        signer, ts = self.getSigner(), time.time()
+        if signer.scheme != 'rsa-sha1':
+            # Only clients that asked for it get this, and it's covered by signature
+            response['signature_scheme'] = signer.scheme
+        if getattr(signer, 'batched', False):
+            # Merkle-batch signatures cover canonical json, and are returned via deferred
+            data = json.dumps(response, sort_keys=True, separators=(',', ':'))
+            return signer.sign(data).addCallback(self.batchSigned, response, ts)
+        signature = signer.sign(json.dumps(response))
+        metric_stage.observe(time.time() - ts, 'sign')
+        self.request.span.mark('sign')
         response['signature'] = base64.standard_b64encode(signature)
 
         return json.dumps(response)
 
+    def batchSigned(self, (signature, proof), response, ts):
+        metric_stage.observe(time.time() - ts, 'sign')
+        self.request.span.mark('sign')
+        response['signature'] = base64.standard_b64encode(signature)
+        response['merkle_proof'] = list(
+            [side, base64.standard_b64encode(digest)] for side, digest in proof )
+        return json.dumps(response)
+
     def sendResponse(self, code, recordRows):
         fingerprintList = []
         if recordRows is not None:
@@ -49,6 +81,19 @@ class NotaryResponse:
                 fingerprintList.append(fingerprint)
         result = self.signResponse({'fingerprintList' : fingerprintList})
 
+        if isinstance(result, defer.Deferred):
+            result.addCallbacks(self.writeResponse, self.signError, callbackArgs=[code])
+        else: self.writeResponse(result, code)
+
+    def signError(self, err):
+        self.request.log.warn('Failed to sign response: %s', err.getErrorMessage())
+        if self.request._disconnected: return
+        self.request.setResponseCode(503)
+        self.request.write('<html><body>Internal Error</body></html>')
+        self.request.finish()
+
+    def writeResponse(self, result, code):
+        if self.request._disconnected: return
         self.request.setHeader('Content-Type', 'application/json')
         self.request.setHeader('Content-Length', str(len(result)))
         self.request.setResponseCode(code)
@@ -0,0 +1,78 @@
+#-*- coding: utf-8 -*-
+
+from twisted.web import server, http
+
+from convergence import metrics
+
+import time, logging
+
+log = logging.getLogger(__name__)
+
+metric_rejected = metrics.counter( 'notary_rejected_total',
+    'Connections to notary TLS ports rejected due to max connections limit.' )
+metric_requests = metrics.counter( 'notary_requests_total',
+    'Requests to notary TLS ports, by whether connection'
+        ' was reused for them (keep-alive) or not.', ['connection'] )
+metric_responses = metrics.counter( 'notary_responses_total',
+    'Responses sent from notary TLS ports, by HTTP response code.', ['code'] )
+
+
+# HTTPChannel for notary requests, keeping connection open between these
+#  for up to "keepalive_timeout" seconds and "max_requests" requests.
+
+class NotaryChannel(http.HTTPChannel):
+
+    def __init__(self):
+        http.HTTPChannel.__init__(self)
+        self.requests_received = 0
+
+    def checkPersistence(self, request, version):
+        # Called once for each request, after all of its headers were received
+        self.requests_received += 1
+        request.channel_request_no = self.requests_received
+        request.headers_received = time.time()
+        metric_requests.inc('reused' if self.requests_received > 1 else 'new')
+        if self.factory.max_requests and self.requests_received >= self.factory.max_requests:
+            request.responseHeaders.setRawHeaders('connection', ['close'])
+            return False
+        return http.HTTPChannel.checkPersistence(self, request, version)
+
+    def allContentReceived(self):
+        http.HTTPChannel.allContentReceived(self)
+        # Keep-alive timeout should not fire while response is being prepared
+        self.setTimeout(None)
+
+    def requestDone(self, request):
+        http.HTTPChannel.requestDone(self, request)
+        if not self.requests: self.setTimeout(self.factory.keepalive_timeout)
+
+    def connectionLost(self, reason):
+        self.factory.channels.discard(self)
+        http.HTTPChannel.connectionLost(self, reason)
+
+
+class NotarySite(server.Site):
+
+    protocol = NotaryChannel
+
+    def __init__(self, resource, keepalive_timeout=None, max_requests=None, max_connections=None, **kws):
+        if keepalive_timeout: kws['timeout'] = keepalive_timeout
+        server.Site.__init__(self, resource, **kws)
+        self.keepalive_timeout = self.timeOut
+        self.max_requests, self.max_connections = max_requests, max_connections
+        self.channels = set()
+        metrics.gauge( 'notary_connections',
+            'Open connections to notary TLS ports.', func=lambda: len(self.channels) )
+
+    def log(self, request):
+        metric_responses.inc(bytes(request.code))
+        server.Site.log(self, request)
+
+    def buildProtocol(self, addr):
+        if self.max_connections and len(self.channels) >= self.max_connections:
+            log.debug('Rejecting connection from %s: max connections limit reached', addr)
+            metric_rejected.inc()
+            return None
+        p = server.Site.buildProtocol(self, addr)
+        if p is not None: self.channels.add(p)
+        return p
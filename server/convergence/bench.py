@@ -0,0 +1,338 @@
+#-*- coding: utf-8 -*-
+
+'''
+End-to-end load generator for notary, used by "convergence bench" command.
+
+Starts local TLS servers with self-signed certificates as stand-in
+targets for verification and a notary subprocess with its own temporary
+database, then drives a configurable mix of requests to it over plain HTTP
+(i.e. measuring notary itself, not TLS), reporting throughput, latency,
+notary CPU/RSS usage and cache hit ratio (as reported by notary metrics).
+'''
+
+from __future__ import print_function
+
+from twisted.internet import reactor, defer, protocol, ssl, task
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+
+from OpenSSL import crypto
+
+from StringIO import StringIO
+from collections import defaultdict, namedtuple
+from contextlib import closing
+from os.path import join, dirname, realpath
+import os, re, sys, time, random, socket, resource, tempfile, shutil, subprocess, logging
+
+log = logging.getLogger(__name__)
+
+
+Target = namedtuple('Target', 'host port fingerprint')
+
+core_path = join(dirname(realpath(__file__)), 'core.py')
+
+
+def free_port():
+    with closing(socket.socket()) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def make_cert(cert_path, key_path, cn, bits=2048):
+    'Generates self-signed certificate, returning its sha1 fingerprint, as seen by notary.'
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, bits)
+    cert = crypto.X509()
+    cert.get_subject().CN = cn
+    cert.set_serial_number(random.getrandbits(64))
+    cert.gmtime_adj_notBefore(-3600)
+    cert.gmtime_adj_notAfter(7 * 24 * 3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    with open(cert_path, 'w') as dst: dst.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    with open(key_path, 'w') as dst: dst.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    return cert.digest('sha1')
+
+def random_fingerprint():
+    return ':'.join('{:02X}'.format(random.getrandbits(8)) for n in xrange(20))
+
+def percentile(values, p):
+    'Returns p-th percentile of a sorted list.'
+    if not values: return None
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+class StandInTargets(object):
+    'Local TLS servers to act as verification targets, which only do the handshake.'
+
+    def __init__(self, tmpdir, count):
+        self.tmpdir, self.count = tmpdir, count
+        self.targets, self.ports = list(), list()
+
+    def start(self):
+        factory = protocol.Factory()
+        factory.protocol = protocol.Protocol
+        for n in xrange(self.count):
+            cert, key = (join(self.tmpdir, 'target-{}.{}'.format(n, ext)) for ext in ['crt', 'key'])
+            fingerprint = make_cert(cert, key, 'target-{}.local'.format(n))
+            port = reactor.listenSSL( 0, factory,
+                ssl.DefaultOpenSSLContextFactory(key, cert), interface='127.0.0.1' )
+            self.ports.append(port)
+            self.targets.append(Target('127.0.0.1', port.getHost().port, fingerprint))
+        return self.targets
+
+    def stop(self):
+        return defer.DeferredList(list(port.stopListening() for port in self.ports))
+
+
+class NotaryProcess(object):
+    'Notary subprocess with its own temporary database and keys.'
+
+    def __init__(self, tmpdir, backend, backend_options=None, args=()):
+        self.tmpdir, self.backend, self.backend_options = tmpdir, backend, backend_options
+        self.args, self.proc = list(args), None
+        self.port, self.metrics_port = free_port(), free_port()
+
+    def start(self, timeout=30):
+        db, key = join(self.tmpdir, 'notary.db'), join(self.tmpdir, 'notary.key')
+        make_cert(join(self.tmpdir, 'notary.crt'), key, 'notary.local')
+        subprocess.check_call([sys.executable, core_path, 'createdb', db])
+        cmd = [ sys.executable, core_path, 'notary', '--no-https',
+            '-i', '127.0.0.1', '-p', '0', '-s', bytes(self.port), '-k', key, '-d', db,
+            '--metrics-port', bytes(self.metrics_port), '-b', self.backend ]
+        if self.backend_options: cmd.extend(['-o', self.backend_options])
+        cmd.extend(self.args)
+        log.debug('Starting notary: %s', ' '.join(cmd))
+        self.proc = subprocess.Popen(cmd)
+        deadline = time.time() + timeout
+        while True:
+            if self.proc.poll() is not None:
+                raise RuntimeError('Notary process exited with code {}'.format(self.proc.returncode))
+            try: socket.create_connection(('127.0.0.1', self.port), 1).close()
+            except socket.error:
+                if time.time() > deadline: raise RuntimeError('Timed out waiting for notary to start')
+                time.sleep(0.1)
+            else: break
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+
+    def cpu(self):
+        'Returns user+system CPU time of the process in seconds, if available (linux).'
+        try:
+            with open('/proc/{}/stat'.format(self.proc.pid)) as src:
+                stat = src.read().rsplit(')', 1)[-1].split()
+        except (IOError, OSError): return None
+        return (int(stat[11]) + int(stat[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+    def rss(self):
+        'Returns resident set size of the process in KiB, if available (linux).'
+        try:
+            with open('/proc/{}/status'.format(self.proc.pid)) as src:
+                for line in src:
+                    if line.startswith('VmRSS:'): return int(line.split()[1])
+        except (IOError, OSError): return None
+
+
+class LoadStats(object):
+
+    def __init__(self):
+        self.latencies, self.codes, self.errors = list(), defaultdict(int), 0
+        self.started = self.finished = None
+
+    def add(self, latency, code):
+        self.latencies.append(latency)
+        self.codes[code] += 1
+
+    def summary(self):
+        latencies, duration = sorted(self.latencies), self.finished - self.started
+        return dict(
+            requests=len(latencies), errors=self.errors,
+            codes=dict((bytes(k), v) for k, v in self.codes.viewitems()),
+            duration=duration, rps=len(latencies) / duration if duration else None,
+            latency=dict(
+                mean=sum(latencies) / len(latencies) if latencies else None,
+                p50=percentile(latencies, 50), p90=percentile(latencies, 90),
+                p99=percentile(latencies, 99), max=latencies[-1] if latencies else None ) )
+
+
+class NotaryClient(object):
+
+    def __init__(self, port, concurrency):
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = concurrency
+        self.agent = Agent(reactor, pool=self.pool)
+        self.url = 'http://127.0.0.1:{}'.format(port)
+
+    @defer.inlineCallbacks
+    def request(self, host, port, fingerprint=None, address=None, headers=None):
+        'Returns (code, body) tuple, using POST if fingerprint is specified.'
+        url = '{}/target/{}+{}'.format(self.url, host, port)
+        if address: url += '/{}'.format(address)
+        headers = Headers(dict((k, [v]) for k, v in (headers or dict()).viewitems()))
+        if not fingerprint: body = None
+        else:
+            headers.setRawHeaders('Content-Type', ['application/x-www-form-urlencoded'])
+            body = FileBodyProducer(StringIO('fingerprint={}'.format(fingerprint)))
+        response = yield self.agent.request('POST' if fingerprint else 'GET', url, headers, body)
+        body = yield readBody(response)
+        defer.returnValue((response.code, body))
+
+    @defer.inlineCallbacks
+    def metrics(self, port):
+        'Returns dict of (name, labels) -> value from notary metrics page.'
+        response = yield self.agent.request('GET', 'http://127.0.0.1:{}/'.format(port))
+        body, values = (yield readBody(response)), dict()
+        for line in body.splitlines():
+            match = re.search(r'^(\w+)(?:\{(.*)\})? (\S+)$', line)
+            if match: values[match.group(1), match.group(2) or ''] = float(match.group(3))
+        defer.returnValue(values)
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+
+def cache_counts(metrics_before, metrics_after):
+    counts = dict()
+    for result in 'hit', 'miss':
+        k = 'convergence_target_cache_total', 'result="{}"'.format(result)
+        counts[result] = int(metrics_after.get(k, 0) - metrics_before.get(k, 0))
+    total = sum(counts.viewvalues())
+    counts['hit_ratio'] = float(counts['hit']) / total if total else None
+    return counts
+
+
+@defer.inlineCallbacks
+def drive_load(client, targets, opts, stats, pick_request):
+    'Runs opts.concurrency workers, sending requests returned by pick_request().'
+    deadline = time.time() + opts.duration if opts.duration else None
+    counter = iter(xrange(opts.requests)) if opts.requests else None
+
+    @defer.inlineCallbacks
+    def worker():
+        while True:
+            if deadline and time.time() > deadline: break
+            if counter and next(counter, None) is None: break
+            target, fingerprint = pick_request(targets)
+            ts = time.time()
+            try: code, body = yield client.request(target.host, target.port, fingerprint)
+            except Exception as err:
+                log.debug('Request error: %s', err)
+                stats.errors += 1
+            else: stats.add(time.time() - ts, code)
+
+    stats.started = time.time()
+    yield defer.DeferredList(list(worker() for n in xrange(opts.concurrency)))
+    stats.finished = time.time()
+
+
+def request_mix(hit_ratio, post_ratio):
+    '''Returns function to pick (target, fingerprint) for next request.
+        Misses are POSTs with random fingerprint, hits are either
+        GETs or POSTs with target fingerprint, known from the warm-up.'''
+    def pick(targets):
+        target = random.choice(targets)
+        if random.random() >= hit_ratio: return target, random_fingerprint()
+        return target, target.fingerprint if random.random() < post_ratio else None
+    return pick
+
+
+@defer.inlineCallbacks
+def measure(notary, client, load_func):
+    '''Runs load_func(stats) (returning deferred), and returns results
+        from stats, along with notary resource usage and cache hit ratio.'''
+    metrics_before = yield client.metrics(notary.metrics_port)
+    cpu_before, rusage_before = notary.cpu(), resource.getrusage(resource.RUSAGE_SELF)
+
+    rss = list()
+    rss_check = task.LoopingCall(lambda: rss.append(notary.rss()))
+    rss_check.start(1.0)
+    stats = LoadStats()
+    try: yield load_func(stats)
+    finally: rss_check.stop()
+
+    cpu_after, rusage_after = notary.cpu(), resource.getrusage(resource.RUSAGE_SELF)
+    metrics_after = yield client.metrics(notary.metrics_port)
+
+    results = stats.summary()
+    cpu = cpu_after - cpu_before if cpu_before is not None else None
+    rss = filter(None, rss)
+    results.update(
+        cache=cache_counts(metrics_before, metrics_after),
+        notary=dict( cpu_seconds=cpu, rss_max_kb=max(rss) if rss else None,
+            cpu_percent=cpu / results['duration'] * 100 if cpu is not None else None ),
+        client=dict(cpu_seconds=sum( getattr(rusage_after, k) - getattr(rusage_before, k)
+            for k in ['ru_utime', 'ru_stime'] )) )
+    defer.returnValue(results)
+
+
+@defer.inlineCallbacks
+def run_load(notary, targets, opts, pick_request):
+    'Warms up notary cache with all targets and runs load, returning results dict.'
+    client = NotaryClient(notary.port, opts.concurrency)
+    try:
+        for target in targets: yield client.request(target.host, target.port, target.fingerprint)
+        results = yield measure( notary, client,
+            lambda stats: drive_load(client, targets, opts, stats, pick_request) )
+    finally: yield client.close()
+    defer.returnValue(results)
+
+
+@defer.inlineCallbacks
+def with_notary(tmpdir, opts, args, load_func):
+    '''Starts notary process with specified extra args,
+        runs load_func(notary) (returning deferred) and stops it afterwards.'''
+    notary = NotaryProcess( tempfile.mkdtemp(dir=tmpdir),
+        opts.backend, opts.backend_options, args )
+    notary.start() # blocks, but nothing should be happening in reactor yet
+    log.info('Notary started on port %s', notary.port)
+    try: result = yield load_func(notary)
+    finally: notary.stop()
+    defer.returnValue(result)
+
+
+def run_with_targets(opts, func):
+    '''Starts stand-in targets and runs func(tmpdir, targets)
+        (returning deferred) under reactor, returning its result.'''
+    tmpdir = tempfile.mkdtemp(prefix='convergence-bench.')
+    targets, result = StandInTargets(tmpdir, opts.targets), list()
+    try:
+        @defer.inlineCallbacks
+        def run():
+            try: result.append((yield func(tmpdir, targets.start())))
+            except Exception as err: log.exception('Benchmark failed: %s', err)
+            finally:
+                yield targets.stop()
+                reactor.stop()
+        reactor.callWhenRunning(run)
+        reactor.run()
+    finally: shutil.rmtree(tmpdir, ignore_errors=True)
+    if not result: raise RuntimeError('Benchmark did not produce any results')
+    return result[0]
+
+
+def run_bench(opts):
+    pick_request = request_mix(opts.hit_ratio, opts.post_ratio)
+    results = run_with_targets(opts, lambda tmpdir, targets: with_notary( tmpdir, opts,
+        opts.notary_arg, lambda notary: run_load(notary, targets, opts, pick_request) ))
+    results['config'] = dict( (k, getattr(opts, k)) for k in [ 'backend', 'backend_options',
+        'targets', 'concurrency', 'duration', 'requests', 'hit_ratio', 'post_ratio', 'notary_arg' ] )
+    return results
+
+
+def format_results(results):
+    lat = dict((k, v * 1000 if v is not None else float('nan')) for k, v in results['latency'].viewitems())
+    notary = dict((k, v if v is not None else float('nan')) for k, v in results['notary'].viewitems())
+    results = dict(results, notary=notary)
+    if results['rps'] is None: results['rps'] = float('nan')
+    lines = [
+        'Requests: {0[requests]} in {0[duration]:.1f}s ({0[rps]:.1f} rps), errors: {0[errors]}',
+        'Response codes: ' + ', '.join('{}: {}'.format(k, v) for k, v in sorted(results['codes'].viewitems())),
+        'Latency (ms): mean {1[mean]:.1f}, p50 {1[p50]:.1f}, p90 {1[p90]:.1f}, p99 {1[p99]:.1f}, max {1[max]:.1f}',
+        'Notary cache: {0[cache][hit]} hit(s), {0[cache][miss]} miss(es)',
+        'Notary CPU: {0[notary][cpu_seconds]:.1f}s ({0[notary][cpu_percent]:.1f}%),'
+            ' max RSS: {0[notary][rss_max_kb]} KiB',
+        'Load generator CPU: {0[client][cpu_seconds]:.1f}s' ]
+    return '\n'.join(line.format(results, lat) for line in lines)
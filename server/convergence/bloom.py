@@ -0,0 +1,58 @@
+#-*- coding: utf-8 -*-
+
+'''
+Bloom filter - set membership test with no false negatives,
+configurable rate of false positives and small fixed memory footprint.
+
+Used to tell whether notary has never seen specific target location,
+without having to look it up in the database.
+'''
+
+import math, struct, hashlib
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity, error_rate=0.01):
+        'Sized for "capacity" items, with "error_rate" false positives when filled up to it.'
+        if not 0 < error_rate < 1: raise ValueError('error_rate must be in (0, 1) range')
+        self.capacity, self.error_rate = max(1, int(capacity)), error_rate
+        bits = -self.capacity * math.log(error_rate) / math.log(2) ** 2
+        self.bits = int(math.ceil(bits / 8.0)) * 8
+        self.hashes = max(1, int(round(self.bits / float(self.capacity) * math.log(2))))
+        self.array, self.count = bytearray(self.bits // 8), 0
+
+    def positions(self, key):
+        # Double hashing (Kirsch-Mitzenmacher), with both hashes taken from a single md5
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return ((h1 + n * h2) % self.bits for n in xrange(self.hashes))
+
+    def add(self, key):
+        'Returns True if key was (probably) already in the set.'
+        array, found = self.array, True
+        for pos in self.positions(key):
+            byte, bit = pos >> 3, 1 << (pos & 7)
+            if not array[byte] & bit:
+                array[byte] |= bit
+                found = False
+        if not found: self.count += 1
+        return found
+
+    def __contains__(self, key):
+        array = self.array
+        for pos in self.positions(key):
+            if not array[pos >> 3] & (1 << (pos & 7)): return False
+        return True
+
+    def __len__(self):
+        'Approximate number of distinct items added.'
+        return self.count
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    @property
+    def size(self):
+        'Size of the bit array, in bytes.'
+        return len(self.array)
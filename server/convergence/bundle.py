@@ -123,9 +123,19 @@ def promptForPhysicalInfo(count):
     certificatePath = loopingPrompt(
         textwrap.fill('Path to PEM encoded certificate for ' + host + ':', 78) + ' ' )
     certificate = loadCertificate(certificatePath)
+    signKeyPath = raw_input(textwrap.fill(
+        'Path to response-signing key for ' + host + ' (--sign-key option),'
+        ' or leave empty if it is not used:', 78 ) + ' ').strip()
     count += 1
 
-    return {'host' : host, 'ssl_port' : sslPort, 'http_port' : httpPort, 'certificate' : certificate}
+    info = {'host' : host, 'ssl_port' : sslPort, 'http_port' : httpPort, 'certificate' : certificate}
+    if signKeyPath:
+        # Only public key and scheme are included, for clients that can use these
+        from convergence.signing import load_signer
+        signer = load_signer(open(signKeyPath).read())
+        info.update(signature_scheme=signer.scheme, signature_key=signer.public_pem)
+
+    return info
 
 def promptForBundleInfo():
     count = 1
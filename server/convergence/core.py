@@ -88,55 +88,141 @@ def get_backend_list():
 
 
 def build_notary(opts, verifier):
-    from convergence.pages import TargetPage, InfoPage
+    from convergence.pages import TargetPage, InfoPage, MetricsPage
+    from convergence import metrics
     from convergence.ConnectChannel import ConnectChannelFactory
+    from convergence.NotarySite import NotarySite
+    from convergence.signing import RSASigner, MerkleBatchSigner, load_signer
 
     from twisted.web import http, server, resource
     from twisted.web.iweb import IAccessLogFormatter
-    from twisted.application import strports, service
+    from twisted.application import strports, service, internet
     from twisted.enterprise import adbapi
     from zope.interface import provider
 
+    log = logging.getLogger('convergence.core')
+
     @provider(IAccessLogFormatter)
     def taggedLogFormatter(timestamp, request):
-        'Extends access log with a tag field to tie in with other (e.g. debug) logging.'
+        '''Extends access log with a tag field to tie in with other (e.g. debug) logging,
+            and number of the request within keep-alive connection (if tracked for it).'''
         line = http.combinedLogFormatter(timestamp, request)
         try: tag = request.log.tag
         except AttributeError: tag = '-'
-        return '{} "{}"'.format(line, tag)
+        request_no = getattr(request, 'channel_request_no', '-')
+        return '{} "{}" {}'.format(line, tag, request_no)
 
     cert_key_path = opts.cert_key or opts.cert
-    cert_key = open(opts.cert_key or opts.cert).read() # TODO: is it really used?
+    # Keys are parsed once here, not on every signed response
+    signers = [RSASigner(open(cert_key_path).read())]
+    if opts.sign_key:
+        signers.insert(0, load_signer(open(opts.sign_key).read()))
+        log.info('Using %s signatures for clients that accept these', signers[0].scheme)
+    if opts.sign_batch_window:
+        # Wraps the fastest signer available
+        signers.insert(0, MerkleBatchSigner( signers[0],
+            opts.sign_batch_window / 1000.0, opts.sign_batch_max ))
     # See http://twistedmatrix.com/trac/ticket/3629
     #  for the rationale behind check_same_thread=False
+    database_kws = dict(check_same_thread=False)
+    if opts.db_read_threads:
+        # WAL journal allows readers to proceed concurrently with the writer
+        database_kws['cp_openfun'] = lambda conn: conn.execute('PRAGMA journal_mode=WAL')
     database = adbapi.ConnectionPool( 'sqlite3',
-        opts.db, cp_max=1, cp_min=1, check_same_thread=False )
+        opts.db, cp_max=1, cp_min=1, **database_kws )
+    database_ro = None if not opts.db_read_threads else\
+        adbapi.ConnectionPool( 'sqlite3', opts.db,
+            cp_max=opts.db_read_threads, cp_min=1, **database_kws )
+
+    splice_relay = None
+    if opts.proxy_splice_threads:
+        from convergence.splice import SpliceRelay
+        try: splice_relay = SpliceRelay(opts.proxy_splice_threads, opts.proxy_tunnel_buffer or 2**16)
+        except OSError as err:
+            log.error('Unable to use splice relay for proxy tunnels, disabling it: %s', err)
 
     connectFactory = ConnectChannelFactory(
-        timeout=10, logFormatter=taggedLogFormatter )
+        timeout=10, logFormatter=taggedLogFormatter,
+        tunnel_buffer=opts.proxy_tunnel_buffer, splice_relay=splice_relay,
+        connect_stagger=opts.proxy_connect_stagger / 1000.0,
+        max_connections=opts.proxy_max_connections,
+        max_client_connections=opts.proxy_max_client_connections,
+        tunnel_idle=opts.proxy_idle_timeout, tunnel_lifetime=opts.proxy_max_lifetime,
+        resolver_ttl=opts.proxy_dns_ttl )
 
     notary = resource.Resource()
     notary.putChild('', InfoPage(verifier))
-    notary.putChild('target', TargetPage(database, cert_key, verifier))
-    notaryFactory = server.Site(notary, logFormatter=taggedLogFormatter)
+    target = TargetPage(
+        database, signers, verifier,
+        verify_batch_window=opts.verify_batch_window / 1000.0,
+        verify_batch_max=opts.verify_batch_max,
+        max_verifications=opts.max_verifications, max_pending=opts.max_pending,
+        max_db_queue=opts.max_db_queue, shed_retry_after=opts.shed_retry_after,
+        databaseReadConnection=database_ro, miss_concurrency=opts.miss_concurrency,
+        etag_cache_size=opts.etag_cache_size, etag_cache_ttl=opts.etag_cache_ttl,
+        slow_request=opts.slow_request_log,
+        db_filter_error_rate=opts.db_filter_error_rate, db_filter_rebuild=opts.db_filter_rebuild )
+    notary.putChild('target', target)
+    notaryFactory = NotarySite( notary, logFormatter=taggedLogFormatter,
+        keepalive_timeout=opts.keepalive_timeout,
+        max_requests=opts.keepalive_max_requests, max_connections=opts.max_connections )
+
+    # Histograms are only updated when there's something to export them
+    metrics.enabled = bool(opts.metrics_port)
+    metricsFactory = server.Site(MetricsPage())
+    metricsFactory.log = lambda request: None # scrapes shouldn't clutter access log
 
     # It'd be easier and more flexible to specify endpoints in config, but we don't have one yet
     ep_interface = '' if not opts.interface else ':interface={}'.format(opts.interface)
-    tls_endpoint = 'tcp:{{}}{}'.format(ep_interface) if opts.no_https else\
-        'ssl:{{}}{}:certKey={}:privateKey={}'.format(ep_interface, opts.cert, cert_key_path)
+    if opts.no_https:
+        tls_service = lambda port:\
+            strports.service('tcp:{}{}'.format(port, ep_interface), notaryFactory)
+    else:
+        # ssl: strports endpoint does not allow to tweak the context, hence explicit factory
+        from convergence.tls import NotaryContextFactory, read_secret
+        tls_context = NotaryContextFactory( opts.cert, cert_key_path,
+            ciphers=opts.tls_ciphers, curve=opts.tls_curve,
+            session_cache=opts.tls_session_cache, session_timeout=opts.tls_session_timeout,
+            ticket_rotation=opts.tls_ticket_rotation,
+            ticket_secret=opts.tls_ticket_secret and read_secret(opts.tls_ticket_secret) )
+        tls_service = lambda port: internet.SSLServer( port,
+            notaryFactory, tls_context, interface=opts.interface or '' )
+
+    if opts.watchdog_threshold:
+        from convergence.watchdog import Watchdog
+        from twisted.internet import reactor
+        watchdog = Watchdog(opts.watchdog_threshold)
+        reactor.callWhenRunning(watchdog.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', watchdog.stop)
+
+    if opts.profile_dir:
+        from convergence.profiler import SamplingProfiler
+        SamplingProfiler( opts.profile_dir,
+            opts.profile_duration, opts.profile_interval / 1000.0 ).install()
 
     app = service.MultiService()
     if opts.proxy_port:
         strports\
             .service('tcp:{}{}'.format(opts.proxy_port, ep_interface), connectFactory)\
             .setServiceParent(app)
+
+    tls_listeners = app
+    if opts.warmup_locations:
+        from convergence.warmup import Warmup, WarmupService
+        from twisted.internet import reactor
+        warmup = Warmup( target.database, target.etags,
+            opts.warmup_locations, opts.warmup_file, concurrency=opts.db_read_threads or 1 )
+        reactor.addSystemEventTrigger('before', 'shutdown', warmup.save)
+        tls_listeners = WarmupService(warmup, opts.warmup_delay)
+        tls_listeners.setServiceParent(app)
     if opts.tls_port:
-        strports\
-            .service(tls_endpoint.format(opts.tls_port), notaryFactory)\
-            .setServiceParent(app)
+        tls_service(opts.tls_port).setServiceParent(tls_listeners)
     if opts.tls_port_proxied and not opts.tls_port == opts.tls_port_proxied:
+        tls_service(opts.tls_port_proxied).setServiceParent(tls_listeners)
+    if opts.metrics_port:
         strports\
-            .service(tls_endpoint.format(opts.tls_port_proxied), notaryFactory)\
+            .service( 'tcp:{}:interface={}'.format(
+                opts.metrics_port, opts.metrics_interface ), metricsFactory )\
             .setServiceParent(app)
 
     return app
@@ -174,6 +260,35 @@ def main(argv=None):
         cmd.add_argument('-p', '--proxy-port', type=int, metavar='port', default=80,
             help='Port to listen on for CONNECT requests'
                 ' to act as proxy to other notaries (default: %(default)s, 0 - disable).')
+        cmd.add_argument('--proxy-max-connections', type=int, metavar='count', default=0,
+            help='Max number of simultaneous connections (and hence'
+                ' tunnels) to --proxy-port (default: %(default)s, 0 - no limit).')
+        cmd.add_argument('--proxy-max-client-connections', type=int, metavar='count', default=0,
+            help='Max number of simultaneous connections to --proxy-port'
+                ' from the same client IP address (default: %(default)s, 0 - no limit).')
+        cmd.add_argument('--proxy-idle-timeout', type=int, metavar='seconds', default=300,
+            help='Close established proxy tunnels that did not pass any data'
+                ' for (roughly) that time (default: %(default)s, 0 - no timeout).')
+        cmd.add_argument('--proxy-max-lifetime', type=int, metavar='seconds', default=0,
+            help='Close established proxy tunnels after that time,'
+                ' regardless of activity (default: %(default)s, 0 - no limit).')
+        cmd.add_argument('--proxy-connect-stagger', type=float, metavar='ms', default=250,
+            help='Delay before trying to connect to the next destination notary'
+                ' (in order of their past connection time and failure rate), if the'
+                ' previous one did not connect or fail yet (default: %(default)s).')
+        cmd.add_argument('--proxy-dns-ttl', type=int, metavar='seconds', default=300,
+            help='Time to cache resolved addresses of destination notaries for.'
+                ' Entries used after half of that time are refreshed in background.'
+                ' Default: %(default)s (0 - resolve hostname for every connection).')
+        cmd.add_argument('--proxy-tunnel-buffer', type=int, metavar='bytes', default=64 * 2**10,
+            help='High-water mark for write buffer of either side of the proxy tunnel,'
+                ' after which reading from the other side gets paused until it is flushed'
+                ' (default: %(default)s, 0 - use twisted default).')
+        cmd.add_argument('--proxy-splice-threads', type=int, metavar='count', default=0,
+            help='Number of threads to relay data for established proxy tunnels'
+                ' between sockets via splice(2) syscall (linux-only), instead of'
+                ' passing it through python. --proxy-tunnel-buffer is used as'
+                ' kernel pipe size in that case. Default: %(default)s (0 - disable).')
         cmd.add_argument('-s', '--tls-port', type=int, metavar='port', default=443,
             help='Port to listen on for direct TLS connections (default: %(default)s, 0 - disable).')
         cmd.add_argument('-x', '--tls-port-proxied', type=int, metavar='port',
@@ -187,11 +302,52 @@ def main(argv=None):
             help='Turn off TLS wrapping for all sockets, e.g. to put Twisted behind Nginx.'
                 ' Also disables --tls-port-proxied (unless explicitly specified) as redundant'
                     ' -- these connections should be proxied to the same --tls-port instead.')
+        cmd.add_argument('--tls-ciphers', metavar='openssl_cipher_list',
+            help='OpenSSL cipher list string for notary TLS endpoints'
+                ' (default: only ECDHE/DHE key exchange with AES-GCM, ChaCha20 or AES-CBC).')
+        cmd.add_argument('--tls-curve', metavar='name', default='prime256v1',
+            help='Elliptic curve to use for ECDHE key exchange (default: %(default)s).')
+        cmd.add_argument('--tls-session-cache', type=int, metavar='count', default=20480,
+            help='Size of the server-side TLS session cache, allowing clients'
+                ' to resume sessions without full handshake (default: %(default)s, 0 - disable).')
+        cmd.add_argument('--tls-session-timeout', type=int, metavar='seconds', default=3600,
+            help='Lifetime of cached TLS sessions (default: %(default)s).')
+        cmd.add_argument('--tls-ticket-rotation', type=int, metavar='seconds', default=12 * 3600,
+            help='Interval to rotate TLS session-ticket keys at'
+                ' (default: %(default)s, 0 - disable session tickets).')
+        cmd.add_argument('--tls-ticket-secret', metavar='path',
+            help='File with a secret (at least 32 bytes) to derive TLS session-ticket keys from,'
+                ' so that any notary processes sharing it will accept each others\' tickets.'
+                ' Random per-process secret is used if not specified.')
+        cmd.add_argument('--keepalive-timeout', type=int, metavar='seconds', default=15,
+            help='Time to keep idle connections to --tls-port and --tls-port-proxied'
+                ' open for, waiting for next request (default: %(default)s).')
+        cmd.add_argument('--keepalive-max-requests', type=int, metavar='count', default=100,
+            help='Max number of requests to serve over one connection to notary TLS ports,'
+                ' closing it after that (default: %(default)s, 0 - no limit).')
+        cmd.add_argument('--max-connections', type=int, metavar='count', default=0,
+            help='Max number of open connections to notary TLS ports,'
+                ' rejecting new ones until some of these get closed.'
+                ' Default: %(default)s (0 - no limit).')
         cmd.add_argument('-i', '--interface', metavar='ip_or_hostname',
             help='Interface (IP address or hostname) to listen on for incoming connections (optional).')
         cmd.add_argument('-c', '--cert', metavar='path', help='TLS certificate path.')
         cmd.add_argument('-k', '--cert-key', metavar='path',
             help='TLS private key path. Not necessary if also contained in the --cert file.')
+        cmd.add_argument('--sign-key', metavar='path',
+            help='Private key (ECDSA P-256 or Ed25519) to sign responses with for clients'
+                ' that list its scheme in X-Convergence-Signature-Schemes header,'
+                ' which is much faster than default RSA signatures with --cert-key.'
+                ' Can be generated via "gencert --sign-scheme" command.')
+        cmd.add_argument('--sign-batch-window', type=float, metavar='ms', default=0,
+            help='Time window to collect responses over, signing these'
+                ' with a single private-key operation over merkle tree root,'
+                ' for clients that accept "merkle-<scheme>" signatures, in milliseconds.'
+                ' Adds up to that much latency to each response.'
+                ' Default: %(default)s (0 - disable).')
+        cmd.add_argument('--sign-batch-max', type=int, metavar='count', default=256,
+            help='Max number of responses in one merkle-tree signature batch,'
+                ' with --sign-batch-window enabled (default: %(default)s, 0 - no limit).')
         cmd.add_argument('-d', '--db', metavar='path', default=default_db_path,
             help='SQLite database path (default: %(default)s).')
         cmd.add_argument('-b', '--backend', metavar='name',
@@ -200,6 +356,177 @@ def main(argv=None):
         cmd.add_argument('-o', '--backend-options', metavar='data',
             help='Backend-specific options-string (e.g. host to query'
                 ' for "dns" backend), use "-b help" to get more info on these.')
+        cmd.add_argument('--verify-batch-window', type=float, metavar='ms', default=0,
+            help='Time window to group concurrent cache misses into a single batch'
+                ' for the verifier backend, in milliseconds (default: %(default)s, 0 - disable).'
+                ' Only makes sense for backends that can actually process batches'
+                ' more efficiently than separate requests (e.g. "dns").')
+        cmd.add_argument('--verify-batch-max', type=int, metavar='count', default=50,
+            help='Max number of targets in one verifier batch, with'
+                ' --verify-batch-window enabled (default: %(default)s, 0 - no limit).')
+        cmd.add_argument('--etag-cache-size', type=int, metavar='count', default=10000,
+            help='Number of target record-set ETags to keep in memory, to answer'
+                ' conditional GET requests (If-None-Match) without database lookup.'
+                ' Default: %(default)s (0 - always check the database).')
+        cmd.add_argument('--etag-cache-ttl', type=int, metavar='seconds', default=60,
+            help='Time to trust cached ETags for before checking'
+                ' the database again (default: %(default)s).')
+        cmd.add_argument('--db-read-threads', type=int, metavar='count', default=0,
+            help='Number of threads with separate database connections to use'
+                ' for record lookups (cache hits), so that these will not have to wait'
+                ' for updates (done on cache misses) to finish. Switches database to WAL'
+                ' journal mode. Default: %(default)s (0 - use same connection for everything).')
+        cmd.add_argument('--db-filter-error-rate', type=float, metavar='0-1.0', default=0,
+            help='Keep in-memory bloom filter of locations (host:port) recorded in database,'
+                ' sized for specified false-positive rate (e.g. 0.01), and skip'
+                ' database lookups for locations that were never seen before.'
+                ' Only safe if nothing else adds records to the same database,'
+                ' unless occasional unnecessary verification (until filter is rebuilt)'
+                ' is acceptable. Default: %(default)s (0 - disabled).')
+        cmd.add_argument('--db-filter-rebuild', type=int, metavar='seconds', default=0,
+            help='Interval to rebuild location filter at, see --db-filter-error-rate option.'
+                ' Filter is always rebuilt when number of locations in it reaches its capacity.'
+                ' Default: %(default)s (0 - only build it on startup and when it fills up).')
+        cmd.add_argument('--warmup-locations', type=int, metavar='count', default=0,
+            help='Number of locations to look up records for on startup, to warm up database'
+                ' and in-memory caches. These are taken from --warmup-file, if it exists,'
+                ' or most recently updated ones in database otherwise.'
+                ' Default: %(default)s (0 - disabled).')
+        cmd.add_argument('--warmup-file', metavar='path',
+            help='File to read locations (host:port, one per line) for cache warm-up from,'
+                ' see --warmup-locations option. Most recently requested locations'
+                ' (as tracked by ETag cache, see --etag-cache-size) are written there on shutdown.')
+        cmd.add_argument('--warmup-delay', type=float, metavar='seconds', default=30,
+            help='Max time to delay starting notary TLS listeners for, until'
+                ' cache warm-up is finished, continuing it in the background afterwards.'
+                ' Default: %(default)s (0 - always do warm-up in the background).')
+        cmd.add_argument('--miss-concurrency', type=int, metavar='count', default=0,
+            help='Max number of cache misses (verification and records update)'
+                ' to process at the same time, queueing the rest, so that these'
+                ' will not hog all resources from cache hits.'
+                ' Default: %(default)s (0 - no limit).')
+        cmd.add_argument('--max-verifications', type=int, metavar='count', default=0,
+            help='Limit on the number of verifications in progress (or queued, see'
+                ' --miss-concurrency option), after which any'
+                ' new cache misses are rejected with 503 response (cache hits are'
+                ' still served as usual). Default: %(default)s (0 - no limit).')
+        cmd.add_argument('--max-pending', type=int, metavar='count', default=0,
+            help='Limit on the number of distinct targets being processed at the same time,'
+                ' after which any new cache misses are rejected with 503 response.'
+                ' Default: %(default)s (0 - no limit).')
+        cmd.add_argument('--max-db-queue', type=int, metavar='count', default=0,
+            help='Limit on the number of queued database operations,'
+                ' after which any new cache misses are rejected with 503 response.'
+                ' Default: %(default)s (0 - no limit).')
+        cmd.add_argument('--shed-retry-after', type=int, metavar='seconds', default=10,
+            help='Retry-After header value to send with 503'
+                ' responses when load limits are exceeded (default: %(default)s).')
+        cmd.add_argument('--slow-request-log', type=float, metavar='seconds', default=5,
+            help='Log (at WARNING level) time taken by each processing phase'
+                ' (parse, db_lookup, coalesce_wait, verify, db_update, sign, write)'
+                ' for target requests that took longer than specified time in total.'
+                ' Same breakdown is logged for all requests with --debug.'
+                ' Default: %(default)s (0 - disable).')
+        cmd.add_argument('--watchdog-threshold', type=float, metavar='seconds', default=0,
+            help='Log stack traces of code blocking the event loop'
+                ' (and count these in metrics) for longer than specified time'
+                ' (e.g. 1.0), as sampled from a separate watchdog thread.'
+                ' Default: %(default)s (0 - disable).')
+        cmd.add_argument('--profile-dir', metavar='path',
+            help='Directory to write profiling results to, when sampling profiler'
+                ' is triggered by SIGUSR2 signal (e.g. "pkill -USR2 -f convergence").'
+                ' Results are in "collapsed stacks" format, as used by flamegraph.pl.'
+                ' Signal is not handled (i.e. kills the process) if not specified.')
+        cmd.add_argument('--profile-duration', type=float, metavar='seconds', default=30,
+            help='Time to collect stack samples for, once profiler is triggered (default: %(default)s).')
+        cmd.add_argument('--profile-interval', type=float, metavar='ms', default=10,
+            help='Interval between stack samples for profiler, in milliseconds (default: %(default)s).')
+        cmd.add_argument('--metrics-port', type=int, metavar='port', default=0,
+            help='Port to serve runtime metrics (in Prometheus text format)'
+                ' over plain HTTP on (default: %(default)s, 0 - disable).')
+        cmd.add_argument('--metrics-interface', metavar='ip_or_hostname', default='127.0.0.1',
+            help='Interface (IP address or hostname) for --metrics-port (default: %(default)s).')
+
+    with subcommand('bench',
+            help='Run local notary with stand-in TLS targets and measure its throughput.') as cmd:
+        cmd.add_argument('-b', '--backend', default='test_positive',
+            choices=['test_positive', 'test_negative', 'perspective'],
+            help='Verifier backend for notary (default: %(default)s).')
+        cmd.add_argument('-o', '--backend-options', metavar='data',
+            help='Backend-specific options-string for notary.')
+        cmd.add_argument('-a', '--notary-arg', action='append', metavar='arg', default=list(),
+            help='Extra command-line argument to pass to notary (e.g. "-a=--miss-concurrency=4").'
+                ' Can be specified multiple times.')
+        cmd.add_argument('-t', '--targets', type=int, metavar='count', default=4,
+            help='Number of local TLS servers to start as verification targets (default: %(default)s).')
+        cmd.add_argument('-n', '--concurrency', type=int, metavar='count', default=16,
+            help='Number of requests to keep in flight (default: %(default)s).')
+        cmd.add_argument('-d', '--duration', type=float, metavar='seconds', default=10,
+            help='Time to run the load for (default: %(default)s, 0 - until --requests are sent).')
+        cmd.add_argument('-r', '--requests', type=int, metavar='count', default=0,
+            help='Number of requests to send (default: %(default)s, 0 - until --duration runs out).')
+        cmd.add_argument('--hit-ratio', type=float, metavar='0-1.0', default=0.9,
+            help='Fraction of requests for known target fingerprints (cache hits),'
+                ' the rest being POSTs with random fingerprints (default: %(default)s).')
+        cmd.add_argument('--post-ratio', type=float, metavar='0-1.0', default=0.5,
+            help='Fraction of POST requests (with fingerprint) among'
+                ' cache hits, the rest being GETs (default: %(default)s).')
+        cmd.add_argument('-j', '--json-output', metavar='path',
+            help='Path to write results (along with the parameters) to, in JSON format.')
+
+    with subcommand('replay',
+            help='Replay /target requests from notary access log(s) against local notary.') as cmd:
+        cmd.add_argument('log_file', nargs='+',
+            help='Access log file(s) to replay requests from, "-" to read from stdin.')
+        cmd.add_argument('-b', '--backend', default='test_positive',
+            choices=['test_positive', 'test_negative', 'perspective'],
+            help='Verifier backend for notary (default: %(default)s).')
+        cmd.add_argument('-o', '--backend-options', metavar='data',
+            help='Backend-specific options-string for notary.')
+        cmd.add_argument('-a', '--notary-arg', action='append', metavar='arg', default=list(),
+            help='Extra command-line argument to pass to notary (e.g. "-a=--miss-concurrency=4").'
+                ' Can be specified multiple times. Ignored if --variant is used.')
+        cmd.add_argument('-V', '--variant', action='append', metavar='args', default=list(),
+            help='Space-separated notary command-line arguments (e.g. "--db-read-threads=4"),'
+                ' to replay same requests against separate (fresh) notary with each of these.'
+                ' Can be specified multiple times to compare results.')
+        cmd.add_argument('-t', '--targets', type=int, metavar='count', default=16,
+            help='Number of local TLS servers to map logged targets to (default: %(default)s).')
+        cmd.add_argument('-s', '--speed', type=float, metavar='factor', default=1.0,
+            help='Replay speed, relative to logged timestamps (default: %(default)s).')
+        cmd.add_argument('-n', '--concurrency', type=int, metavar='count', default=64,
+            help='Max number of persistent connections to notary (default: %(default)s).'
+                ' Requests are sent on schedule regardless, opening new connections if necessary.')
+        cmd.add_argument('-l', '--limit', type=int, metavar='count',
+            help='Only replay specified number of first requests from the log(s).')
+        cmd.add_argument('-j', '--json-output', metavar='path',
+            help='Path to write results (for each variant) to, in JSON format.')
+
+    with subcommand('microbench',
+            help='Time hot-path notary components (signing, db lookups, etc) in isolation.') as cmd:
+        cmd.add_argument('-g', '--group', action='append', metavar='name',
+            choices=['sign', 'db', 'x509', 'context', 'log'],
+            help='Only run specified group of benchmarks (choices: %(choices)s).'
+                ' Can be specified multiple times. Default is to run all of them.')
+        cmd.add_argument('-r', '--repeat', type=int, metavar='count', default=7,
+            help='Number of timed runs for each benchmark (default: %(default)s).')
+        cmd.add_argument('--min-time', type=float, metavar='seconds', default=0.2,
+            help='Min duration of each timed run, number of calls'
+                ' per run is picked to match it (default: %(default)s).')
+        cmd.add_argument('--db-rows', metavar='n1,n2,...', default='1e3,1e5,1e6',
+            help='Comma-separated list of synthetic database sizes'
+                ' (in rows) to run db benchmarks with (default: %(default)s).')
+        cmd.add_argument('--db-dir', metavar='path',
+            help='Directory to keep generated synthetic databases in,'
+                ' to reuse them between runs (default: temporary directory, removed afterwards).'
+                ' Generating large (e.g. 1e8 rows) database can take a while.')
+        cmd.add_argument('--san-count', type=int, metavar='count', default=200,
+            help='Number of subjectAltName entries in generated certificate (default: %(default)s).')
+        cmd.add_argument('--cert', action='append', metavar='path', default=list(),
+            help='PEM certificate (e.g. from a CDN) to use instead of generated one.'
+                ' Can be specified multiple times.')
+        cmd.add_argument('-j', '--json-output', metavar='path',
+            help='Path to write results to, in JSON format.')
 
     with subcommand('bundle',
             help='Produce notary "bundles", which can be easily imported to a web browser.') as cmd:
@@ -207,10 +534,36 @@ def main(argv=None):
             nargs='?', default='mynotarybundle.notary',
             help='Path to write resulting bundle to (default: %(default)s).')
 
-    with subcommand('createdb', help='Construct Convergence Notary database.') as cmd:
+    with subcommand('createdb', help='Construct Convergence Notary database.'
+            ' Can also be used on existing database to add any missing indexes to it.') as cmd:
         cmd.add_argument('db_path', nargs='?', default=default_db_path,
             help='SQLite database path (default: %(default)s).')
 
+    with subcommand('exportdb', help='Export fingerprint records from notary database.') as cmd:
+        cmd.add_argument('-d', '--db', metavar='path', default=default_db_path,
+            help='SQLite database path (default: %(default)s).')
+        cmd.add_argument('-o', '--output', metavar='path', default='-',
+            help='Path to write records to (default: %(default)s - stdout).')
+        cmd.add_argument('-f', '--format', choices=['ndjson', 'binary'], default='ndjson',
+            help='Output format - newline-delimited JSON or'
+                ' more compact binary one (default: %(default)s).')
+
+    with subcommand('importdb',
+            help='Import fingerprint records (as produced by'
+                ' "exportdb" command) into notary database.') as cmd:
+        cmd.add_argument('input', nargs='*', default=['-'],
+            help='Path(s) to read records from (default: - - stdin),'
+                ' in any format supported by "exportdb" command (detected automatically).')
+        cmd.add_argument('-d', '--db', metavar='path', default=default_db_path,
+            help='SQLite database path (default: %(default)s).'
+                ' Created if missing, records for the same location and fingerprint'
+                ' are merged with existing ones. Best done with notary stopped,'
+                ' as database is locked for writes during the import.')
+        cmd.add_argument('--batch-size', type=int, metavar='rows', default=50000,
+            help='Number of records to insert at once (default: %(default)s).')
+        cmd.add_argument('--cache-size', type=int, metavar='MiB', default=256,
+            help='SQLite page cache size to use for the import (default: %(default)s).')
+
     with subcommand('gencert', help='Generates TLS certificates.') as cmd:
         cmd.add_argument('-c', '--cert', metavar='path', default='mynotary.pem',
             help='Generated TLS certificate path (default: %(default)s.')
@@ -223,12 +576,18 @@ def main(argv=None):
             help='Size of the generated cert RSA key in bits (e.g. 2048 or 4096, default: %(default)s).')
         cmd.add_argument('--cert-expire', metavar='days', type=int, default=14600,
             help='Expiration period for generated cert in days (default: %(default)s).')
+        cmd.add_argument('--sign-scheme', choices=['ecdsa-p256-sha256', 'ed25519'],
+            help='Also generate separate key for signing notary responses with specified scheme'
+                ' (see --sign-key option for "notary" command). Ed25519 requires OpenSSL 1.1.1+.')
+        cmd.add_argument('--sign-key', metavar='path',
+            help='Generated signing key path, if --sign-scheme is specified'
+                ' (defaults to --cert name + ".sign.key", e.g. "mynotary.sign.key").')
 
     if argv is None: argv = sys.argv[1:]
     opts = parser.parse_args(argv)
 
     # This must be done before any other twisted-related stuff and imports
-    if opts.call == 'notary': reactor = install_reactor()
+    if opts.call in ['notary', 'bench', 'replay']: reactor = install_reactor()
 
 
     ## Configuration files (if any)
@@ -266,6 +625,8 @@ def main(argv=None):
             opts.tls_port_proxied = default_proxied_tls_port # stays disabled otherwise
 
         from convergence.verifier import OptionsError
+        from convergence.tls import TicketKeysError
+        from convergence.signing import SignerError
 
         # To present list of these in CLI help
         backends = get_backend_list()
@@ -304,13 +665,53 @@ def main(argv=None):
         try: backend = backend.load().verifier(opts.backend_options)
         except OptionsError as err: parser.error(err.message)
 
-        build_notary(opts, backend).startService()
+        # Unreadable/invalid key or secret files, unsupported
+        #  --sign-key type, OpenSSL not supporting ticket keys
+        try: notary = build_notary(opts, backend)
+        except SignerError as err:
+            parser.error('Failed to load response-signing key ({}): {}'.format(opts.sign_key, err))
+        except (IOError, ValueError, TicketKeysError) as err:
+            parser.error('Failed to set up notary: {}'.format(err))
+        notary.startService()
 
         log.debug('Convergence Notary started...')
         reactor.run()
         log.debug('Convergence Notary stopped')
         return
 
+    elif opts.call == 'bench':
+        if not (opts.duration or opts.requests):
+            parser.error('Either -d/--duration or -r/--requests must be non-zero.')
+        import json
+        from convergence.bench import run_bench, format_results
+        try: results = run_bench(opts)
+        except RuntimeError as err: return print(err.message, file=sys.stderr)
+        print(format_results(results))
+        if opts.json_output:
+            with open(opts.json_output, 'w') as dst: json.dump(results, dst, indent=2, sort_keys=True)
+        return
+
+    elif opts.call == 'replay':
+        import json
+        from convergence.bench import format_results
+        from convergence.replay import run_replay
+        try: results = run_replay(opts)
+        except RuntimeError as err: return print(err.message, file=sys.stderr)
+        for result in results:
+            print('\n-- Notary options: {}'.format(' '.join(result['config']['notary_args']) or '-'))
+            print(format_results(result))
+        if opts.json_output:
+            with open(opts.json_output, 'w') as dst: json.dump(results, dst, indent=2, sort_keys=True)
+        return
+
+    elif opts.call == 'microbench':
+        import json
+        from convergence.microbench import run_microbench
+        results = run_microbench(opts)
+        if opts.json_output:
+            with open(opts.json_output, 'w') as dst: json.dump(results, dst, indent=2, sort_keys=True)
+        return
+
     elif opts.call == 'bundle':
         from convergence.bundle import promptForBundleInfo, writeBundle
 
@@ -326,16 +727,49 @@ def main(argv=None):
 
     elif opts.call == 'createdb':
         from sqlite3 import connect
+        from convergence.schema import schema
 
         db_dir = dirname(realpath(opts.db_path))
         if not exists(db_dir): os.makedirs(db_dir)
 
         with connect(opts.db_path) as connection,\
                 closing(connection.cursor()) as cursor:
-            cursor.execute(
-                'CREATE TABLE fingerprints (id integer'
-                ' primary key, location TEXT, fingerprint TEXT, timestamp_start'
-                ' INTEGER, timestamp_finish INTEGER)' )
+            for statement in schema: cursor.execute(statement)
+        return
+
+    elif opts.call == 'exportdb':
+        from sqlite3 import connect
+        from convergence.dbdump import export_rows, write_ndjson, write_binary
+
+        if not exists(opts.db): return print('Database does not exist: {}'.format(opts.db), file=sys.stderr)
+        write = write_ndjson if opts.format == 'ndjson' else write_binary
+        with closing(connect(opts.db)) as connection:
+            dst = sys.stdout if opts.output == '-' else open(opts.output, 'wb')
+            try: count = write(export_rows(connection), dst)
+            finally:
+                if dst is not sys.stdout: dst.close()
+        log.info('Exported %s record(s)', count)
+        return
+
+    elif opts.call == 'importdb':
+        import itertools as it
+        from sqlite3 import connect
+        from convergence.dbdump import read_rows, import_rows, DumpFormatError
+
+        db_dir = dirname(realpath(opts.db))
+        if not exists(db_dir): os.makedirs(db_dir)
+
+        srcs = list(sys.stdin if path == '-' else open(path, 'rb') for path in opts.input)
+        try:
+            with closing(connect(opts.db)) as connection:
+                counts = import_rows( connection, it.chain.from_iterable(it.imap(read_rows, srcs)),
+                    batch_size=opts.batch_size, cache_size=opts.cache_size )
+        except DumpFormatError as err: return print(err.message, file=sys.stderr)
+        finally:
+            for src in srcs:
+                if src is not sys.stdin: src.close()
+        print( 'Imported {0[imported]} record(s), database now has'
+            ' {0[after]} record(s) (was: {0[before]})'.format(counts) )
         return
 
     elif opts.call == 'gencert':
@@ -348,6 +782,8 @@ def main(argv=None):
 
         if opts.cert_key is None:
             opts.cert_key = '{}.key'.format(opts.cert.rsplit('.', 1)[0])
+        if opts.sign_scheme and opts.sign_key is None:
+            opts.sign_key = '{}.sign.key'.format(opts.cert.rsplit('.', 1)[0])
 
         def run_command(*argv):
             argv = map(bytes, argv)
@@ -368,12 +804,21 @@ def main(argv=None):
             # Sign the request
             run_command( 'openssl', 'x509', '-req', '-days',
                 opts.cert_expire, '-in', csr_path, '-signkey', opts.cert_key, '-out', opts.cert )
+            # Response-signing key
+            if opts.sign_scheme == 'ecdsa-p256-sha256':
+                run_command( 'openssl', 'ecparam',
+                    '-name', 'prime256v1', '-genkey', '-noout', '-out', opts.sign_key )
+            elif opts.sign_scheme == 'ed25519':
+                run_command('openssl', 'genpkey', '-algorithm', 'ed25519', '-out', opts.sign_key)
         except RuntimeError as err:
             if key_path: os.unlink(key_path)
             return print(err.message, file=sys.stderr)
         finally: os.unlink(csr_path)
 
-        return print('Certificate and key generated in {} and {}'.format(opts.cert, key_path))
+        print('Certificate and key generated in {} and {}'.format(opts.cert, key_path))
+        if opts.sign_scheme:
+            print('Response-signing key ({}) generated in {}'.format(opts.sign_scheme, opts.sign_key))
+        return
 
     else: raise NotImplementedError(opts.call)
     raise AssertionError('Command {!r} did not return.'.format(opts.call))
@@ -0,0 +1,177 @@
+#-*- coding: utf-8 -*-
+
+'''
+Streaming export/import of notary fingerprint records,
+used by "convergence exportdb" and "convergence importdb" commands.
+
+Two formats are supported:
+ - "ndjson" - one JSON object per line, with keys same as db columns.
+ - "binary" - "CVFP1\n" header, followed by records, each of which is a flags byte
+   (1 - new location follows, 2 - fingerprint is in binary form), location
+   (uint16 length + utf-8) if it differs from the previous record, fingerprint
+   (uint8 length + bytes, hex-colon ones like x509.digest() output decoded to
+   raw bytes) and start/finish timestamps as int64, all little-endian.
+Import auto-detects format by the header.
+
+Importing into an existing database merges records for the same location and
+fingerprint into one, spanning from the earliest start to the latest finish
+(same as notary does for these), rewriting the table in location order.
+'''
+
+from convergence.schema import schema
+
+from contextlib import closing
+import re, json, time, struct, binascii, logging
+
+log = logging.getLogger(__name__)
+
+
+formats = 'ndjson', 'binary'
+binary_magic = 'CVFP1\n'
+
+columns = 'location', 'fingerprint', 'timestamp_start', 'timestamp_finish'
+
+fingerprint_hex_re = re.compile(r'^[0-9A-F]{2}(:[0-9A-F]{2})*$')
+
+progress_interval = 10.0
+
+
+class DumpFormatError(Exception): pass
+
+
+def export_rows(conn):
+    'Yields record tuples from the database, grouped by location.'
+    with closing(conn.cursor()) as cursor:
+        cursor.execute('SELECT {} FROM fingerprints ORDER BY location'.format(', '.join(columns)))
+        while True:
+            chunk = cursor.fetchmany(10000)
+            if not chunk: break
+            for row in chunk: yield row
+
+
+def write_ndjson(rows, dst):
+    count = 0
+    for row in rows:
+        dst.write(json.dumps(dict(zip(columns, row)), sort_keys=True))
+        dst.write('\n')
+        count += 1
+    return count
+
+def write_binary(rows, dst):
+    dst.write(binary_magic)
+    count, last_location = 0, None
+    for location, fingerprint, ts_start, ts_finish in rows:
+        flags, chunks = 0, list()
+        if location != last_location:
+            location_raw = location.encode('utf-8')
+            flags |= 1
+            chunks.append(struct.pack('<H', len(location_raw)) + location_raw)
+            last_location = location
+        fingerprint = fingerprint.encode('utf-8')
+        if fingerprint_hex_re.search(fingerprint):
+            flags |= 2
+            fingerprint = binascii.unhexlify(fingerprint.replace(':', ''))
+        chunks.append(struct.pack('<B', len(fingerprint)) + fingerprint)
+        chunks.append(struct.pack('<qq', int(ts_start), int(ts_finish)))
+        dst.write(struct.pack('<B', flags) + ''.join(chunks))
+        count += 1
+    return count
+
+
+def read_ndjson(src):
+    for n, line in enumerate(src, 1):
+        if not line.strip(): continue
+        try:
+            record = json.loads(line)
+            yield tuple(record[k] for k in columns)
+        except (ValueError, KeyError, TypeError) as err:
+            raise DumpFormatError('Invalid record on line {}: {}'.format(n, err))
+
+def read_binary(src):
+    def read(size):
+        data = src.read(size)
+        if len(data) != size: raise DumpFormatError('Unexpected end of binary dump')
+        return data
+    location = None
+    while True:
+        flags = src.read(1)
+        if not flags: break
+        flags = ord(flags)
+        if flags & 1:
+            location = read(struct.unpack('<H', read(2))[0]).decode('utf-8')
+        elif location is None: raise DumpFormatError('Record without location at the start of dump')
+        fingerprint = read(ord(read(1)))
+        if flags & 2: fingerprint = ':'.join('{:02X}'.format(ord(c)) for c in fingerprint)
+        else: fingerprint = fingerprint.decode('utf-8')
+        ts_start, ts_finish = struct.unpack('<qq', read(16))
+        yield location, fingerprint, ts_start, ts_finish
+
+def read_rows(src):
+    'Yields record tuples from the dump stream, detecting its format.'
+    header = src.read(len(binary_magic))
+    if header == binary_magic: return read_binary(src)
+    # Can be a non-seekable stream, so put header back in front of it
+    first = header + src.readline()
+    def lines():
+        yield first
+        for line in src: yield line
+    return read_ndjson(lines())
+
+
+def import_rows(conn, rows, batch_size=50000, cache_size=256):
+    '''Inserts records into database in large batches, merging these with
+        existing ones in a single transaction, with indexes created at the end.
+        Returns dict of row counts - imported, in db before and after.'''
+    conn.isolation_level = None # explicit transactions only
+    conn.execute('PRAGMA cache_size=-{}'.format(int(cache_size * 1024)))
+    for statement in schema: conn.execute(statement)
+    rows_before = conn.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+    if not rows_before:
+        # Nothing to lose on crash - import can be simply re-run
+        conn.execute('PRAGMA synchronous=OFF')
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DROP TABLE IF EXISTS fingerprints_import')
+        conn.execute( 'CREATE TABLE fingerprints_import (location TEXT,'
+            ' fingerprint TEXT, timestamp_start INTEGER, timestamp_finish INTEGER)' )
+
+        ts = ts_progress = time.time()
+        count, chunk = 0, list()
+        insert = 'INSERT INTO fingerprints_import ({}) VALUES (?, ?, ?, ?)'.format(', '.join(columns))
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) < batch_size: continue
+            conn.executemany(insert, chunk)
+            count += len(chunk)
+            del chunk[:]
+            if time.time() - ts_progress >= progress_interval:
+                log.info( 'Imported %s record(s) in %.1fs (%.0f/s)',
+                    count, time.time() - ts, count / (time.time() - ts) )
+                ts_progress = time.time()
+        if chunk: conn.executemany(insert, chunk)
+        count += len(chunk)
+        log.info('Imported %s record(s) in %.1fs, merging these into database', count, time.time() - ts)
+
+        ts = time.time()
+        # Indexes are dropped while table is rewritten and re-created afterwards
+        indexes = conn.execute( 'SELECT name, sql FROM sqlite_master WHERE type = ?'
+            ' AND tbl_name = ? AND sql IS NOT NULL', ('index', 'fingerprints') ).fetchall()
+        for name, sql in indexes: conn.execute('DROP INDEX "{}"'.format(name))
+        if rows_before:
+            conn.execute( 'INSERT INTO fingerprints_import ({0})'
+                ' SELECT {0} FROM fingerprints'.format(', '.join(columns)) )
+            conn.execute('DELETE FROM fingerprints')
+        conn.execute( 'INSERT INTO fingerprints ({0}) SELECT location, fingerprint,'
+            ' MIN(timestamp_start), MAX(timestamp_finish) FROM fingerprints_import'
+            ' GROUP BY location, fingerprint'.format(', '.join(columns)) )
+        conn.execute('DROP TABLE fingerprints_import')
+        for name, sql in indexes: conn.execute(sql)
+        rows_after = conn.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    log.info('Merged records and rebuilt indexes in %.1fs', time.time() - ts)
+
+    return dict(imported=count, before=rows_before, after=rows_after)
@@ -0,0 +1,141 @@
+#-*- coding: utf-8 -*-
+
+'''
+Process-wide registry of runtime metrics (counters, gauges),
+exported in Prometheus text format via MetricsPage (see pages.py).
+
+Updating counters and gauges is just a dict lookup and addition,
+so they're always maintained, regardless of whether exported or not.
+Histograms are only updated when "enabled" is set (i.e. metrics are exported).
+'''
+
+from collections import OrderedDict
+import bisect
+
+
+prefix = 'convergence_'
+enabled = False
+
+latency_buckets = 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30
+
+
+class Metric(object):
+
+    mtype = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labels = prefix + name, doc, tuple(labels)
+        self.values = dict()
+
+    def samples(self):
+        for labels, value in sorted(self.values.viewitems()):
+            yield self.name, zip(self.labels, labels), value
+
+
+class Counter(Metric):
+
+    mtype = 'counter'
+
+    def inc(self, *labels):
+        self.values[labels] = self.values.get(labels, 0) + 1
+
+    def add(self, value, *labels):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    '''Gauge with either explicitly set values or a callable to get value on export.
+        With labels, callable should return dict of label-values tuples to values.'''
+
+    mtype = 'gauge'
+
+    def __init__(self, name, doc, labels=(), func=None):
+        super(Gauge, self).__init__(name, doc, labels)
+        self.func = func
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        if not self.func:
+            for sample in super(Gauge, self).samples(): yield sample
+        elif not self.labels: yield self.name, (), self.func()
+        else:
+            for labels, value in sorted(self.func().viewitems()):
+                yield self.name, zip(self.labels, labels), value
+
+
+class Histogram(Metric):
+
+    mtype = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=latency_buckets):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        if not enabled: return
+        counts = self.values.get(labels)
+        if counts is None: counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value # sum, last bucket before it is +Inf
+
+    def samples(self):
+        for labels, counts in sorted(self.values.viewitems()):
+            labels, total = zip(self.labels, labels), 0
+            for le, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield self.name + '_bucket', labels + [('le', le)], total
+            yield self.name + '_sum', labels, counts[-1]
+            yield self.name + '_count', labels, total
+
+
+def _escape(value):
+    return bytes(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def _format(value):
+    if isinstance(value, float): return repr(value)
+    return bytes(int(value))
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        'Adds metric to registry, returning already-registered one with the same name, if any.'
+        registered = self.metrics.get(metric.name)
+        if registered is None: registered = self.metrics[metric.name] = metric
+        elif type(registered) is not type(metric):
+            raise TypeError( 'Metric {!r} is already registered'
+                ' with a different type: {}'.format(metric.name, registered.mtype) )
+        return registered
+
+    def counter(self, name, doc, labels=()):
+        return self.register(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=(), func=None):
+        gauge = self.register(Gauge(name, doc, labels))
+        if func: gauge.func = func
+        return gauge
+
+    def histogram(self, name, doc, labels=(), buckets=latency_buckets):
+        return self.register(Histogram(name, doc, labels, buckets))
+
+    def render(self):
+        lines = list()
+        for metric in self.metrics.viewvalues():
+            lines.append('# HELP {} {}'.format(metric.name, metric.doc))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.mtype))
+            for name, labels, value in metric.samples():
+                if labels:
+                    name = '{}{{{}}}'.format( name,
+                        ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels) )
+                lines.append('{} {}'.format(name, _format(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+counter, gauge, histogram, render =\
+    registry.counter, registry.gauge, registry.histogram, registry.render
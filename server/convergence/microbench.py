@@ -0,0 +1,307 @@
+#-*- coding: utf-8 -*-
+
+'''
+Microbenchmarks for notary hot-path building blocks, used by "convergence microbench" command.
+
+Each case is a callable, run in a loop (with gc disabled) enough times for a
+single run to take at least "min_time", repeated several times after a warm-up
+run, reporting median time per call and spread (interquartile range) between runs.
+Everything runs offline and in-process - keys, certificates and synthetic
+databases are generated locally, and DB queries are run synchronously
+(without adbapi thread pools) to isolate these from any scheduling overhead.
+'''
+
+from __future__ import print_function
+
+from twisted.internet import defer
+
+from OpenSSL import crypto
+
+from contextlib import closing
+from os.path import join, exists
+import os, gc, time, random, sqlite3, tempfile, shutil, logging
+
+log = logging.getLogger(__name__)
+
+
+groups = 'sign', 'db', 'x509', 'context', 'log'
+
+
+def measure(func, repeat=7, min_time=0.2):
+    'Returns number of loops and list of per-call times for each of the "repeat" runs.'
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        loops = 1
+        while True: # calibration, also serves as a warm-up
+            ts = time.time()
+            for n in xrange(loops): func()
+            elapsed = time.time() - ts
+            if elapsed >= min_time: break
+            loops *= 10 if elapsed < min_time / 10 else 2
+        times = list()
+        for n in xrange(repeat):
+            ts = time.time()
+            for n in xrange(loops): func()
+            times.append((time.time() - ts) / loops)
+        return loops, times
+    finally:
+        if gc_enabled: gc.enable()
+
+def summary(loops, times):
+    times = sorted(times)
+    quartile = lambda q: times[int(round(q * (len(times) - 1)))]
+    return dict( loops=loops, runs=len(times),
+        min=times[0], median=quartile(0.5), iqr=quartile(0.75) - quartile(0.25) )
+
+
+class SyncConnectionPool(object):
+    '''Runs adbapi.ConnectionPool queries and interactions inline on a single
+        sqlite3 connection, returning already-fired deferreds.'''
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def runQuery(self, *args, **kws):
+        with closing(self.conn.cursor()) as cursor:
+            cursor.execute(*args, **kws)
+            return defer.succeed(cursor.fetchall())
+
+    def runInteraction(self, interaction, *args, **kws):
+        with closing(self.conn.cursor()) as cursor:
+            try: result = interaction(cursor, *args, **kws)
+            except:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+            return defer.succeed(result)
+
+
+class FakeRequest(object):
+    'Bare minimum of twisted.web Request, as used by NotaryResponse.signResponse.'
+
+    class span(object):
+        @staticmethod
+        def mark(phase): pass
+
+    def __init__(self, headers=None):
+        self.headers = headers or dict()
+
+    def getHeader(self, k):
+        return self.headers.get(k.lower())
+
+
+def synthetic_location(n):
+    return 'host-{}.example.com:443'.format(n)
+
+def synthetic_db(path, rows, batch=100000):
+    '''Creates sqlite database with specified number of rows in "fingerprints" table,
+        with 1-3 fingerprints per location. Returns number of distinct locations.'''
+    from convergence.schema import schema
+    rng, ts = random.Random(rows), int(time.time())
+    def records():
+        location, n = 0, 0
+        while n < rows:
+            for m in xrange(min(rng.randint(1, 3), rows - n)):
+                fingerprint = ':'.join('{:02X}'.format(rng.getrandbits(8)) for k in xrange(20))
+                start = ts - rng.randint(0, 365 * 86400)
+                yield synthetic_location(location), fingerprint, start, start + rng.randint(0, 86400)
+                n += 1
+            location += 1
+    with closing(sqlite3.connect(path)) as conn:
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
+        for statement in schema: conn.execute(statement)
+        chunk, records = list(), records()
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= batch:
+                conn.executemany( 'INSERT INTO fingerprints (location, fingerprint,'
+                    ' timestamp_start, timestamp_finish) VALUES (?, ?, ?, ?)', chunk )
+                del chunk[:]
+        if chunk:
+            conn.executemany( 'INSERT INTO fingerprints (location, fingerprint,'
+                ' timestamp_start, timestamp_finish) VALUES (?, ?, ?, ?)', chunk )
+        conn.commit()
+    return location_count(path)
+
+def location_count(path):
+    with closing(sqlite3.connect(path)) as conn:
+        return conn.execute('SELECT COUNT(DISTINCT location) FROM fingerprints').fetchone()[0]
+
+def many_san_cert(names, bits=2048):
+    'Returns self-signed pyOpenSSL X509 with subjectAltName for each of the specified names.'
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, bits)
+    cert = crypto.X509()
+    cert.get_subject().CN = names[0]
+    cert.set_serial_number(random.getrandbits(64))
+    cert.gmtime_adj_notBefore(-3600)
+    cert.gmtime_adj_notAfter(7 * 24 * 3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.add_extensions([crypto.X509Extension( 'subjectAltName',
+        False, ', '.join('DNS:{}'.format(name) for name in names) )])
+    cert.sign(key, 'sha256')
+    return cert
+
+def cert_dns_names(x509):
+    names = list()
+    for ext in xrange(x509.get_extension_count()):
+        ext = x509.get_extension(ext)
+        if ext.get_short_name() != 'subjectAltName': continue
+        for val in str(ext).split(','):
+            val = val.strip()
+            if val.startswith('DNS:'): names.append(val[4:])
+    return names
+
+
+def bench_sign(opts):
+    from convergence.NotaryResponse import NotaryResponse
+    from convergence.signing import RSASigner, ECDSASigner, Ed25519Signer, SignerError
+    from M2Crypto import RSA, EC
+
+    signers = [RSASigner(RSA.gen_key(2048, 65537, lambda *a: None).as_pem(cipher=None))]
+    key = EC.gen_params(EC.NID_X9_62_prime256v1)
+    key.gen_key()
+    signers.append(ECDSASigner(key.as_pem(cipher=None)))
+    try:
+        from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+        from cryptography.hazmat.primitives import serialization
+    except ImportError: log.info('Skipping ed25519 signer, "cryptography" module is not available')
+    else:
+        pem = Ed25519PrivateKey.generate().private_bytes( serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8, serialization.NoEncryption() )
+        try: signers.append(Ed25519Signer(pem))
+        except SignerError as err: log.info('Skipping ed25519 signer: %s', err)
+
+    ts = bytes(int(time.time()))
+    fingerprints = list( dict( timestamp=dict(start=ts, finish=ts),
+        fingerprint=':'.join('{:02X}'.format(random.getrandbits(8)) for n in xrange(20)) )
+        for n in xrange(3) )
+    for signer in signers:
+        response = NotaryResponse(FakeRequest(), [signer])
+        yield ( 'signResponse {}'.format(signer.scheme),
+            lambda response=response: response.signResponse(dict(fingerprintList=fingerprints)) )
+
+
+def bench_db(opts):
+    from convergence.FingerprintDatabase import FingerprintDatabase
+
+    tmpdir = None
+    if not opts.db_dir: opts.db_dir = tmpdir = tempfile.mkdtemp(prefix='convergence-microbench.')
+    elif not exists(opts.db_dir): os.makedirs(opts.db_dir)
+    try:
+        for rows in (int(float(n)) for n in opts.db_rows.split(',')):
+            path = join(opts.db_dir, 'microbench-{}.db'.format(rows))
+            if exists(path): locations = location_count(path)
+            else:
+                log.info('Generating synthetic database with %s rows: %s', rows, path)
+                ts = time.time()
+                locations = synthetic_db(path, rows)
+                log.info('Generated database in %.1fs (%s locations)', time.time() - ts, locations)
+
+            with closing(sqlite3.connect(path)) as conn:
+                db, rng = FingerprintDatabase(SyncConnectionPool(conn)), random.Random(rows)
+                hit = lambda: db.getRecordsFor('host-{}.example.com'.format(rng.randrange(locations)), 443)
+                miss = lambda: db.getRecordsFor('host-{}.example.com'.format(locations + rng.getrandbits(32)), 443)
+                # Existing records, so that updates only refresh timestamp_finish, as for most misses
+                records = list(conn.execute( 'SELECT location, fingerprint FROM fingerprints'
+                    ' WHERE id = ?', (rng.randint(1, rows),) ).fetchone() for n in xrange(1000))
+                def update():
+                    location, fingerprint = rng.choice(records)
+                    db.updateRecordsFor(location.rsplit(':', 1)[0], 443, fingerprint)
+                yield 'getRecordsFor hit ({} rows)'.format(rows), hit
+                yield 'getRecordsFor miss ({} rows)'.format(rows), miss
+                yield '_updateRecords ({} rows)'.format(rows), update
+
+                filtered = FingerprintDatabase(SyncConnectionPool(conn), filterErrorRate=0.01)
+                filtered.rebuildLocationFilter()
+                yield 'getRecordsFor miss, location filter ({} rows)'.format(rows),\
+                    lambda: filtered.getRecordsFor('host-{}.example.com'.format(locations + rng.getrandbits(32)), 443)
+    finally:
+        if tmpdir: shutil.rmtree(tmpdir)
+
+
+def bench_x509(opts):
+    from convergence.verifier.perspective import match_x509,\
+        _dnsname_to_pat, CertificateError, SANMatcher, SANMatcherCache
+
+    certs = list()
+    for path in opts.cert:
+        with open(path) as src: certs.append((path, crypto.load_certificate(crypto.FILETYPE_PEM, src.read())))
+    if not certs:
+        names = list( ('*.cdn-{}.example.com' if n % 4 == 0
+            else 'www.site-{}.example.com').format(n) for n in xrange(opts.san_count) )
+        certs.append(('{} SANs'.format(opts.san_count), many_san_cert(names)))
+
+    for label, x509 in certs:
+        names = cert_dns_names(x509)
+        if not names:
+            log.warning('Skipping certificate without DNS subjectAltName entries: %s', label)
+            continue
+        first, last = (name.replace('*', 'matched') for name in [names[0], names[-1]])
+        matchers, digest = SANMatcherCache(), x509.digest('sha1')
+        def nomatch(matchers=None):
+            try: match_x509(x509, 'no-such-name.invalid', matchers=matchers, digest=digest)
+            except CertificateError: pass
+        yield 'match_x509 first SAN ({})'.format(label), lambda: match_x509(x509, first)
+        yield 'match_x509 last SAN ({})'.format(label), lambda: match_x509(x509, last)
+        yield 'match_x509 no match ({})'.format(label), nomatch
+        yield 'match_x509 last SAN, cached ({})'.format(label),\
+            lambda: match_x509(x509, last, matchers=matchers, digest=digest)
+        yield 'match_x509 no match, cached ({})'.format(label), lambda: nomatch(matchers)
+        yield 'SANMatcher ({})'.format(label), lambda: SANMatcher(x509)
+        yield '_dnsname_to_pat x{} ({})'.format(len(names), label), lambda: map(_dnsname_to_pat, names)
+
+
+def bench_context(opts):
+    from convergence.verifier.perspective import CertificateContextFactory
+
+    fingerprint = ':'.join(['00'] * 20)
+    for verify_ca in True, False:
+        factory = CertificateContextFactory( defer.Deferred(),
+            fingerprint, log, verify_ca, hostname='www.example.com' )
+        yield 'CertificateContextFactory.getContext (verify_ca={})'.format(verify_ca), factory.getContext
+
+
+def bench_log(opts):
+    from convergence.pages import TaggedLogger
+
+    logger = logging.getLogger('convergence.microbench.null')
+    logger.propagate = False
+    logger.addHandler(logging.NullHandler())
+    tagged = TaggedLogger(logger)
+
+    for level in logging.INFO, logging.DEBUG:
+        logger.setLevel(level)
+        enabled = 'enabled' if level == logging.DEBUG else 'disabled'
+        yield 'logger.debug ({})'.format(enabled), lambda: logger.debug('Request for %s', 'host')
+        yield 'TaggedLogger.debug ({})'.format(enabled), lambda: tagged.debug('Request for %s', 'host')
+    yield 'TaggedLogger()', lambda: TaggedLogger(logger)
+
+
+def run_microbench(opts):
+    'Returns list of results, one for each benchmark case.'
+    results = list()
+    for group in opts.group or groups:
+        for name, func in globals()['bench_{}'.format(group)](opts):
+            log.debug('Running: %s', name)
+            result = summary(*measure(func, opts.repeat, opts.min_time))
+            result.update(group=group, name=name)
+            results.append(result)
+            print(format_result(result))
+    return results
+
+
+def format_time(seconds):
+    for unit, scale in ('s', 1), ('ms', 1e3), ('us', 1e6):
+        if seconds >= 1.0 / scale: break
+    else: unit, scale = 'ns', 1e9
+    return '{:.2f}{}'.format(seconds * scale, unit)
+
+def format_result(result):
+    return '{:<60} {:>10} /call  (min {}, iqr {:.1f}%, {}x{})'.format(
+        result['name'], format_time(result['median']), format_time(result['min']),
+        result['iqr'] / result['median'] * 100 if result['median'] else 0,
+        result['runs'], result['loops'] )
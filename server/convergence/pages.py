@@ -19,16 +19,18 @@
 #
 
 from convergence.FingerprintDatabase import FingerprintDatabase
-from convergence.NotaryResponse import NotaryResponse
+from convergence.NotaryResponse import NotaryResponse, metric_stage
+from convergence import metrics
 
 from twisted.protocols.basic import FileSender
-from twisted.internet import defer
-from twisted.web import resource, server, error, iweb
+from twisted.internet import defer, reactor
+from twisted.web import resource, server, error, iweb, http
 
 try: from twisted.web.template import renderElement
 except ImportError: renderElement = None
 
-import os, hashlib, json, base64, types, logging
+from collections import OrderedDict
+import os, time, hashlib, json, base64, types, logging
 
 log = logging.getLogger(__name__)
 
@@ -44,6 +46,60 @@ class TaggedLogger(object):
         return lambda tpl,*a,**kw: getattr(self.logger, k)('[{}] {}'.format(self.tag, tpl), *a, **kw)
 
 
+class RequestSpan(object):
+    '''Records duration of each request processing phase, as time since the previous one.
+        Started when request headers are received (if NotaryChannel is used).'''
+
+    def __init__(self, started=None):
+        self.started = self.last = started or time.time()
+        self.phases = list()
+
+    def mark(self, phase):
+        ts = time.time()
+        self.phases.append((phase, ts - self.last))
+        self.last = ts
+
+    @property
+    def total(self):
+        return self.last - self.started
+
+    def __str__(self):
+        return ', '.join('{} {:.3f}s'.format(phase, duration) for phase, duration in self.phases)
+
+
+class ETagCache(object):
+    '''LRU cache of digests for (host, port) record sets, to answer
+        matching conditional GET requests without database lookup.
+        Entries expire after "ttl" seconds, in case database gets updated from elsewhere.'''
+
+    def __init__(self, size, ttl):
+        self.size, self.ttl, self.entries = size, ttl, OrderedDict()
+
+    @staticmethod
+    def digestFor(recordRows):
+        return hashlib.sha1('\n'.join(' '.join(map(str, row)) for row in recordRows)).hexdigest()
+
+    @staticmethod
+    def etagFor(digest, scheme):
+        # Weak, as response body differs between signatures
+        #  (ecdsa ones are not deterministic, merkle proofs depend on batch)
+        return 'W/"{}-{}"'.format(digest, scheme)
+
+    def get(self, key):
+        digest, ts = self.entries.pop(key, (None, None))
+        if digest is None or time.time() - ts > self.ttl: return None
+        self.entries[key] = digest, ts
+        return digest
+
+    def set(self, key, recordRows):
+        digest = self.digestFor(recordRows)
+        if self.size:
+            self.entries.pop(key, None)
+            self.entries[key] = digest, time.time()
+            while len(self.entries) > self.size: self.entries.popitem(last=False)
+        return digest
+
+
 # This class is responsible for responding to actions
 # on the REST noun 'target,' which results in triggering
 # verification or returning certificate histories for
@@ -53,10 +109,59 @@ class TargetPage(resource.Resource):
 
     isLeaf = True
 
-    def __init__(self, databaseConnection, privateKey, verifier):
-        self.database = FingerprintDatabase(databaseConnection)
-        self.verifier, self.privateKey = verifier, privateKey
+    def __init__( self, databaseConnection, signers, verifier,
+            verify_batch_window=None, verify_batch_max=None,
+            max_verifications=None, max_pending=None, max_db_queue=None, shed_retry_after=10,
+            databaseReadConnection=None, miss_concurrency=None,
+            etag_cache_size=10000, etag_cache_ttl=60, slow_request=None,
+            db_filter_error_rate=None, db_filter_rebuild=None ):
+        self.database = FingerprintDatabase( databaseConnection, databaseReadConnection,
+            filterErrorRate=db_filter_error_rate, filterRebuild=db_filter_rebuild )
+        self.verifier, self.signers = verifier, signers
         self.request_hash = dict()
+        self.verify_batch_window, self.verify_batch_max = verify_batch_window, verify_batch_max
+        self.verify_batch, self.verify_batch_timer = list(), None
+
+        # Cache misses (verification and records update) can have their own concurrency budget,
+        #  so that their bursts don't hog all the resources, with the rest waiting in a queue
+        self.miss_lane = defer.DeferredSemaphore(miss_concurrency) if miss_concurrency else None
+
+        self.verifying, self.shedding, self.shed_retry_after = 0, False, shed_retry_after
+        self.limits = [
+            ('verifications', lambda: self.verifying, max_verifications),
+            # request_hash already includes the target being checked, hence +1
+            ('pending', lambda: len(self.request_hash), max_pending and max_pending + 1),
+            ('db_queue', lambda: self.database.pending, max_db_queue) ]
+        self.limits = list((name, value, limit) for name, value, limit in self.limits if limit)
+
+        metrics.gauge( 'target_verifications',
+            'Verifications in progress or queued.', func=lambda: self.verifying )
+        metrics.gauge( 'target_pending',
+            'Distinct targets being processed (size of request_hash).', func=lambda: len(self.request_hash) )
+        metrics.gauge( 'db_queue',
+            'Database queries queued or running.', ['lane'],
+            func=lambda: dict(((k,), v) for k, v in self.database.queued.viewitems()) )
+        metrics.gauge( 'target_miss_queue',
+            'Cache misses waiting for a free slot in the miss lane.',
+            func=lambda: len(self.miss_lane.waiting) if self.miss_lane else 0 )
+        metrics.gauge( 'target_overloaded',
+            'Whether notary currently sheds cache misses (1) or not (0).',
+            func=lambda: int(bool(self.overloaded())) )
+        self.metric_shed = metrics.counter( 'target_shed_total',
+            'Cache-miss requests rejected due to exceeded load limit.', ['limit'] )
+
+        self.etags = ETagCache(etag_cache_size, etag_cache_ttl)
+        self.slow_request = slow_request
+        self.metric_stage = metric_stage # also updated with signing times in NotaryResponse
+        self.metric_cache = metrics.counter( 'target_cache_total',
+            'Target record lookups, by whether recorded fingerprints'
+                ' were enough to respond (hit) or not (miss).', ['result'] )
+        self.metric_requests = metrics.counter( 'target_requests_total',
+            'Target requests, by whether these were coalesced'
+                ' with identical request already in progress.', ['coalesced'] )
+        self.metric_not_modified = metrics.counter( 'target_not_modified_total',
+            'Conditional GET requests answered with 304 Not Modified,'
+                ' by where record set ETag was taken from.', ['source'] )
 
 
     def _check_request_hash(func):
@@ -66,15 +171,18 @@ class TargetPage(resource.Resource):
                 else self.request_hash.pop(request.key)
             for req in requests:
                 if req is not request:
+                    req.span.mark('coalesce_wait')
                     req.log.debug( 'Cloning response'
                         ' (code: %s) from parallel request', code )
                 func(self, req, code, *args, **kws)
         return _send
 
     @_check_request_hash
-    def sendErrorResponse(self, request, code, message):
+    def sendErrorResponse(self, request, code, message, headers=None):
         if request._disconnected: return
         request.setResponseCode(code)
+        if headers:
+            for k, v in headers.viewitems(): request.setHeader(k, v)
         request.write('<html><body>' + message + '</body></html>')
         request.finish()
 
@@ -83,12 +191,39 @@ class TargetPage(resource.Resource):
         if request._disconnected:
             request.log.debug('Lost connection to client before response')
             return
+        if code == 200 and recordRows:
+            digest = self.etags.set(request.key[:2], recordRows)
+            if request.method == 'GET' and self.setETag(request, digest) is http.CACHED:
+                self.metric_not_modified.inc('db')
+                request.finish()
+                return
         # TODO: cache these in _check_request_hash as well
-        response = NotaryResponse(request, self.privateKey)
+        response = NotaryResponse(request, self.signers)
         response.sendResponse(code, recordRows)
 
     del _check_request_hash
 
+    def setETag(self, request, digest):
+        '''Sets ETag for record set digest and signature scheme that
+            client gets, returns http.CACHED if client has it already.'''
+        scheme = NotaryResponse(request, self.signers).getSigner().scheme
+        request.setHeader('Vary', NotaryResponse.schemesHeader)
+        return request.setETag(ETagCache.etagFor(digest, scheme))
+
+
+    def overloaded(self):
+        'Returns name of the first exceeded load limit, if any.'
+        for name, value, limit in self.limits:
+            if value() >= limit: return name
+
+    def checkLoad(self):
+        'Same as overloaded(), but also logs switching to/from load-shedding mode.'
+        limit = self.overloaded()
+        if bool(limit) != self.shedding:
+            self.shedding = bool(limit)
+            if limit: log.warn('Load limit exceeded (%s), shedding cache misses', limit)
+            else: log.info('Load is back within limits, stopped shedding cache misses')
+        return limit
 
     def isCacheMiss(self, recordRows, fingerprint):
         if not recordRows: return True
@@ -97,28 +232,87 @@ class TargetPage(resource.Resource):
             if row[0] == fingerprint: return False
         return True
 
-    @defer.inlineCallbacks
+    def verify(self, host, port, address, fingerprint, log):
+        'Pass target to verifier, grouping concurrent ones into verify_many() batches, if enabled.'
+        if not self.verify_batch_window:
+            return self.verifier.verify(host, port, address, fingerprint, log)
+        deferred = defer.Deferred()
+        self.verify_batch.append((deferred, (host, port, address, fingerprint, log)))
+        if self.verify_batch_max and len(self.verify_batch) >= self.verify_batch_max: self.verifyBatch()
+        elif not self.verify_batch_timer:
+            self.verify_batch_timer = reactor.callLater(self.verify_batch_window, self.verifyBatch)
+        return deferred
+
+    def verifyBatch(self):
+        if self.verify_batch_timer and self.verify_batch_timer.active():
+            self.verify_batch_timer.cancel()
+        batch, self.verify_batch, self.verify_batch_timer = self.verify_batch, list(), None
+        if not batch: return
+        log.debug('Passing batch of %s target(s) to verifier', len(batch))
+        deferreds, targets = zip(*batch)
+
+        def _dispatch(results):
+            for deferred, (success, result) in zip(deferreds, results):
+                if success: deferred.callback(result)
+                else: deferred.errback(result)
+        def _fail(err):
+            for deferred in deferreds:
+                if not deferred.called: deferred.errback(err)
+        defer.maybeDeferred(self.verifier.verify_many, targets).addCallbacks(_dispatch, _fail)
+
     def updateCache(self, request, host, port, address, submittedFingerprint):
+        self.verifying += 1 # includes ones waiting in miss_lane queue
+        if not self.miss_lane:
+            deferred = self._updateCache(request, host, port, address, submittedFingerprint)
+        else:
+            deferred = self.miss_lane.run(
+                self._updateCache, request, host, port, address, submittedFingerprint )
+        def _done(result):
+            self.verifying -= 1
+            return result
+        return deferred.addBoth(_done)
+
+    @defer.inlineCallbacks
+    def _updateCache(self, request, host, port, address, submittedFingerprint):
+        ts = time.time()
         try:
-            code, fingerprint = yield self.verifier.verify(
+            code, fingerprint = yield self.verify(
                 host, int(port), address, submittedFingerprint, request.log )
         except Exception as err:
             request.log.warn('Fetch certificate error: %s', err)
             raise
 
+        self.metric_stage.observe(time.time() - ts, 'verify')
+        request.span.mark('verify')
         request.log.debug('Got fingerprint: %s', fingerprint)
         if fingerprint is None: defer.returnValue((code, None))
         else:
+            ts = time.time()
             try:
                 recordRows = yield self.database.updateRecordsFor(host, port, fingerprint)
             except Exception as err:
                 request.log.warn('Update records error: %s', err)
                 raise
-            else: defer.returnValue((code, recordRows))
+            else:
+                self.metric_stage.observe(time.time() - ts, 'db_update')
+                request.span.mark('db_update')
+                # Record set has changed regardless of response code (e.g. 409 adds new fingerprint)
+                if recordRows: self.etags.set((host, port), recordRows)
+                defer.returnValue((code, recordRows))
 
     @defer.inlineCallbacks
-    def getRecordsComplete(self, recordRows, request, host, port, address, fingerprint):
+    def getRecordsComplete(self, recordRows, request, host, port, address, fingerprint, ts):
+        self.metric_stage.observe(time.time() - ts, 'db_lookup')
+        request.span.mark('db_lookup')
         if self.isCacheMiss(recordRows, fingerprint):
+            self.metric_cache.inc('miss')
+            limit = self.checkLoad()
+            if limit:
+                request.log.debug('Rejecting cache miss, load limit exceeded: %s', limit)
+                self.metric_shed.inc(limit)
+                self.sendErrorResponse( request, 503, 'Overloaded, try again later.',
+                    headers={'Retry-After': bytes(self.shed_retry_after)} )
+                return
             request.log.debug('Handling cache miss...')
             try:
                 code, recordRows = yield self.updateCache(request, host, port, address, fingerprint)
@@ -126,14 +320,25 @@ class TargetPage(resource.Resource):
                 request.log.warn('Certificate-fetch handling error: %s', err)
                 self.sendErrorResponse(request, 503, 'Internal Error')
             else: self.sendResponse(request, code, recordRows)
-        else: self.sendResponse(request, 200, recordRows)
+        else:
+            self.metric_cache.inc('hit')
+            self.sendResponse(request, 200, recordRows)
 
     def getRecordsError(self, error, request):
         request.log.warn('Get records error: %s', error)
         self.sendErrorResponse(request, 503, 'Error retrieving records.')
 
+    def requestFinished(self, result, request):
+        request.span.mark('write' if result is None else 'aborted')
+        if self.slow_request and request.span.total >= self.slow_request:
+            request.log.warn( 'Slow request (%.3fs) for %s: %s',
+                request.span.total, request.uri, request.span )
+        else: request.log.debug('Request phases: %s', request.span)
+
     def render(self, request):
         request.key, request.log = None, TaggedLogger(log)
+        request.span = RequestSpan(getattr(request, 'headers_received', None))
+        request.notifyFinish().addBoth(self.requestFinished, request)
 
         if request.method != 'POST' and request.method != 'GET':
             self.sendErrorResponse(request, 405, 'Unsupported method.')
@@ -160,15 +365,30 @@ class TargetPage(resource.Resource):
         request.log.debug(
             'Checking %s:%s (ip: %s) against %s',
             host, port, address or 'any', fingerprint )
+        request.span.mark('parse')
+
+        if request.method == 'GET' and request.getHeader('if-none-match'):
+            digest = self.etags.get((host, port))
+            if digest:
+                if self.setETag(request, digest) is http.CACHED:
+                    request.log.debug('Record set not modified (digest: %s)', digest)
+                    self.metric_not_modified.inc('memory')
+                    request.finish()
+                    return server.NOT_DONE_YET
+                # Stale or different one, actual ETag is set after lookup, if any
+                request.responseHeaders.removeHeader('etag')
 
         # Group same-target requests arriving at the same time
         request.key = host, port, address, fingerprint
         if request.key in self.request_hash:
+            self.metric_requests.inc('yes')
             self.request_hash[request.key].add(request)
         else:
+            self.metric_requests.inc('no')
             self.request_hash[request.key] = {request}
             deferred = self.database.getRecordsFor(host, port)
-            deferred.addCallback(self.getRecordsComplete, request, host, port, address, fingerprint)
+            deferred.addCallback( self.getRecordsComplete,
+                request, host, port, address, fingerprint, time.time() )
             deferred.addErrback(self.getRecordsError, request)
 
         return server.NOT_DONE_YET
@@ -196,3 +416,14 @@ class InfoPage(resource.Resource):
             else: return renderElement(request, description)
 
         return description
+
+
+class MetricsPage(resource.Resource):
+
+    isLeaf = True
+
+    def render(self, request):
+        if request.method != 'GET':
+            raise error.UnsupportedMethod(['GET'])
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return metrics.render()
@@ -0,0 +1,74 @@
+#-*- coding: utf-8 -*-
+
+'''
+On-demand sampling profiler, started by a signal (SIGUSR2) in a running process.
+
+Samples stacks of all threads from a separate thread at a fixed
+interval for a specified time, writing these in "collapsed" format
+(one "thread;frame1;frame2;... count" line per unique stack),
+as used by flamegraph.pl and compatible tools.
+Nothing is done (aside from installing signal handler) until triggered.
+'''
+
+from twisted.internet import reactor
+
+import os, sys, time, signal, threading, logging
+from collections import defaultdict
+from os.path import join, basename
+
+log = logging.getLogger(__name__)
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, path, duration=30, interval=0.01):
+        self.path, self.duration, self.interval = path, duration, interval
+        self.thread = None
+
+    def install(self, signum=signal.SIGUSR2):
+        signal.signal(signum, self.handleSignal)
+
+    def handleSignal(self, signum, frame):
+        # Handler can interrupt anything in the main thread, so defer the actual work
+        reactor.callFromThread(self.start)
+
+    def start(self):
+        if self.thread is not None:
+            return log.warning('Profiler is already running, ignoring the trigger')
+        if not os.path.isdir(self.path): os.makedirs(self.path)
+        dst = join(self.path, 'profile-{}-{}.collapsed'.format(
+            time.strftime('%Y%m%d_%H%M%S'), os.getpid() ))
+        log.warning('Starting profiler for %ss, output: %s', self.duration, dst)
+        self.thread = threading.Thread(target=self.run, args=(dst,), name='profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def frameName(frame):
+        code = frame.f_code
+        return '{}:{}'.format(basename(code.co_filename), code.co_name)
+
+    def run(self, dst):
+        stacks, samples = defaultdict(int), 0
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        own_ident, deadline = threading.current_thread().ident, time.time() + self.duration
+        try:
+            while time.time() < deadline:
+                for ident, frame in sys._current_frames().viewitems():
+                    if ident == own_ident: continue
+                    stack = list()
+                    while frame is not None:
+                        stack.append(self.frameName(frame))
+                        frame = frame.f_back
+                    if ident not in names:
+                        names.update((t.ident, t.name) for t in threading.enumerate())
+                    stack.append(names.get(ident, 'thread-{}'.format(ident)))
+                    stacks[';'.join(reversed(stack))] += 1
+                samples += 1
+                time.sleep(self.interval)
+            with open(dst, 'w') as out:
+                for stack, count in sorted(stacks.viewitems()):
+                    out.write('{} {}\n'.format(stack, count))
+            log.warning('Profiler finished (%s samples), written to: %s', samples, dst)
+        except Exception as err: log.exception('Profiler failed: %s', err)
+        finally: self.thread = None
@@ -0,0 +1,118 @@
+#-*- coding: utf-8 -*-
+
+'''
+Replay of notary access logs (as written with request tags, see core.build_notary)
+against a local notary, used by "convergence replay" command.
+
+All logged targets are mapped to local stand-in TLS servers (see bench module),
+keeping original hostnames (and hence distinct cache keys) in requests, but with
+stand-in port and address. Fingerprints are not in the logs, so POSTs are sent
+with the stand-in fingerprint, unless original response was 409 (mismatch).
+Requests are sent at the original (or scaled) pace, regardless of responses.
+'''
+
+from twisted.internet import reactor, defer, task
+
+from convergence.bench import NotaryClient, measure,\
+    with_notary, run_with_targets, random_fingerprint
+
+from collections import namedtuple
+import re, sys, time, zlib, shlex, calendar, itertools as it, logging
+
+log = logging.getLogger(__name__)
+
+
+LogEntry = namedtuple('LogEntry', 'ts method host port code')
+
+# Prefix can be anything (e.g. from python logging), "ip" is in quotes with newer twisted
+log_line_re = re.compile(
+    r'"?[\w.:]+"? \S+ \S+ \[(?P<ts>[^\]]+)\]'
+    r' "(?P<method>GET|POST) /target/(?P<host>[^/+\s]+)\+(?P<port>\d+)\S* [^"]*"'
+    r' (?P<code>\d+) ' )
+
+
+def parse_log(lines):
+    'Yields LogEntry tuples for /target requests in the access log lines, in original order.'
+    for line in lines:
+        match = log_line_re.search(line)
+        if not match: continue
+        ts = match.group('ts').split()[0] # twisted always logs these in UTC
+        try: ts = calendar.timegm(time.strptime(ts, '%d/%b/%Y:%H:%M:%S'))
+        except ValueError: continue
+        yield LogEntry( ts, match.group('method'), match.group('host'),
+            int(match.group('port')), int(match.group('code')) )
+
+
+def schedule(entries):
+    '''Returns list of (offset, entry) tuples, with requests logged
+        within the same second spread evenly across it.'''
+    entries, offsets = sorted(entries, key=lambda entry: entry.ts), list()
+    if not entries: return offsets
+    for ts, second in it.groupby(entries, key=lambda entry: entry.ts):
+        second = list(second)
+        offsets.extend( (ts - entries[0].ts + float(n) / len(second), entry)
+            for n, entry in enumerate(second) )
+    return offsets
+
+
+@defer.inlineCallbacks
+def replay_load(client, targets, requests, speed, stats):
+    inflight = set()
+
+    def send(entry):
+        target = targets[zlib.crc32('{}:{}'.format(entry.host, entry.port)) % len(targets)]
+        fingerprint = None if entry.method != 'POST'\
+            else (random_fingerprint() if entry.code == 409 else target.fingerprint)
+        ts = time.time()
+        deferred = client.request(entry.host, target.port, fingerprint, address=target.host)
+        def _done(result):
+            inflight.discard(deferred)
+            if isinstance(result, tuple): stats.add(time.time() - ts, result[0])
+            else:
+                log.debug('Request error: %s', result.getErrorMessage())
+                stats.errors += 1
+        inflight.add(deferred)
+        deferred.addBoth(_done)
+
+    stats.started = time.time()
+    for offset, entry in requests:
+        delay = stats.started + offset / speed - time.time()
+        if delay > 0: yield task.deferLater(reactor, delay, lambda: None)
+        send(entry)
+    yield defer.DeferredList(list(inflight))
+    stats.finished = time.time()
+
+
+def run_replay(opts):
+    entries = list()
+    for path in opts.log_file:
+        src = sys.stdin if path == '-' else open(path)
+        try: entries.extend(parse_log(src))
+        finally:
+            if src is not sys.stdin: src.close()
+    if opts.limit: entries = entries[:opts.limit]
+    if not entries: raise RuntimeError('No /target requests found in specified log(s)')
+    requests = schedule(entries)
+    log.info( 'Replaying %s request(s) over %.1fs (speed: %sx)',
+        len(requests), requests[-1][0] / opts.speed, opts.speed )
+
+    variants = list(shlex.split(args) for args in opts.variant) or [opts.notary_arg]
+
+    @defer.inlineCallbacks
+    def run(tmpdir, targets):
+        results = list()
+        for args in variants:
+            @defer.inlineCallbacks
+            def load(notary):
+                client = NotaryClient(notary.port, opts.concurrency)
+                try:
+                    result = yield measure( notary, client,
+                        lambda stats: replay_load(client, targets, requests, opts.speed, stats) )
+                finally: yield client.close()
+                result['config'] = dict( notary_args=args, backend=opts.backend,
+                    backend_options=opts.backend_options, targets=opts.targets, speed=opts.speed )
+                defer.returnValue(result)
+            results.append((yield with_notary(tmpdir, opts, args, load)))
+        defer.returnValue(results)
+
+    return run_with_targets(opts, run)
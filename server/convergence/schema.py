@@ -0,0 +1,17 @@
+#-*- coding: utf-8 -*-
+
+'''
+SQLite schema of notary fingerprint database.
+
+Kept free of twisted (and any other non-stdlib) imports, so that
+offline commands like "createdb" or "importdb" can use it
+without pulling in notary modules and installing the reactor.
+'''
+
+# Statements to create the database tables, as used by "createdb" command
+# Can be re-applied to existing database, e.g. to add indexes that it lacks
+schema = (
+    'CREATE TABLE IF NOT EXISTS fingerprints (id integer'
+        ' primary key, location TEXT, fingerprint TEXT, timestamp_start'
+        ' INTEGER, timestamp_finish INTEGER)',
+    'CREATE INDEX IF NOT EXISTS fingerprints_location ON fingerprints (location)' )
@@ -0,0 +1,182 @@
+#-*- coding: utf-8 -*-
+
+'''
+Signature schemes for notary responses.
+
+"rsa-sha1" with the TLS certificate key is what all clients expect by default,
+other schemes use a separate (and much cheaper to use) signing key,
+and are only used for clients that explicitly list these as acceptable
+in X-Convergence-Signature-Schemes request header.
+'''
+
+from M2Crypto import BIO, RSA, EC
+
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+from convergence import metrics
+
+import hashlib, logging
+
+log = logging.getLogger(__name__)
+
+metric_batches = metrics.counter( 'sign_batches_total',
+    'Merkle-tree batches signed with a single private-key operation.' )
+metric_batched = metrics.counter( 'sign_batched_total',
+    'Responses signed as a part of merkle-tree batches.' )
+
+
+schemes = 'rsa-sha1', 'ecdsa-p256-sha256', 'ed25519'
+scheme_default = 'rsa-sha1'
+
+
+class SignerError(Exception): pass
+
+
+class Signer(object):
+
+    scheme = None
+
+    def sign(self, data):
+        raise NotImplementedError()
+
+    @property
+    def public_pem(self):
+        raise NotImplementedError()
+
+
+class RSASigner(Signer):
+
+    scheme = 'rsa-sha1'
+
+    def __init__(self, pem):
+        self.key = RSA.load_key_bio(BIO.MemoryBuffer(pem))
+
+    def sign(self, data):
+        return self.key.sign(hashlib.sha1(data).digest(), 'sha1')
+
+    @property
+    def public_pem(self):
+        bio = BIO.MemoryBuffer()
+        self.key.save_pub_key_bio(bio)
+        return bio.read()
+
+
+class ECDSASigner(Signer):
+
+    scheme = 'ecdsa-p256-sha256'
+
+    def __init__(self, pem):
+        self.key = EC.load_key_bio(BIO.MemoryBuffer(pem))
+        if len(self.key) != 256:
+            raise SignerError( 'Only P-256 curve is supported'
+                ' for ECDSA keys, not {}-bit one'.format(len(self.key)) )
+
+    def sign(self, data):
+        # DER-encoded (r, s) pair
+        return self.key.sign_dsa_asn1(hashlib.sha256(data).digest())
+
+    @property
+    def public_pem(self):
+        bio = BIO.MemoryBuffer()
+        self.key.save_pub_key_bio(bio)
+        return bio.read()
+
+
+class Ed25519Signer(Signer):
+
+    scheme = 'ed25519'
+
+    def __init__(self, pem):
+        try:
+            from cryptography.hazmat.primitives.serialization import load_pem_private_key
+            from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+            from cryptography.hazmat.backends import default_backend
+        except ImportError:
+            raise SignerError('"cryptography" module is required for ed25519 signatures')
+        self.key = load_pem_private_key(pem, None, default_backend())
+        if not isinstance(self.key, Ed25519PrivateKey):
+            raise SignerError('Not an ed25519 private key')
+
+    def sign(self, data):
+        return self.key.sign(data)
+
+    @property
+    def public_pem(self):
+        from cryptography.hazmat.primitives import serialization
+        return self.key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo )
+
+
+def load_signer(pem):
+    'Returns Signer for PEM-encoded private key, with scheme detected from key type.'
+    if 'BEGIN RSA PRIVATE KEY' in pem: return RSASigner(pem)
+    if 'BEGIN EC PRIVATE KEY' in pem: return ECDSASigner(pem)
+    if 'BEGIN PRIVATE KEY' in pem: # PKCS#8, can be any key type
+        try: return ECDSASigner(pem)
+        except (EC.ECError, SignerError): pass
+        return Ed25519Signer(pem)
+    raise SignerError('Unrecognized private key format')
+
+
+# Merkle-tree batches, with leaf/node hashes prefixed
+#  by 0/1 bytes to make these distinguishable, as in RFC 6962.
+
+def merkle_leaf(data): return hashlib.sha256(b'\x00' + data).digest()
+def merkle_node(left, right): return hashlib.sha256(b'\x01' + left + right).digest()
+
+def merkle_levels(leaves):
+    'Returns list of tree levels, from leaves to [root], with odd nodes promoted as-is.'
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append(list(
+            merkle_node(level[n], level[n+1]) if n + 1 < len(level) else level[n]
+            for n in xrange(0, len(level), 2) ))
+    return levels
+
+def merkle_proof(levels, n):
+    'Returns list of (side, hash) tuples for a path from leaf number n to root.'
+    proof = list()
+    for level in levels[:-1]:
+        sibling = n ^ 1
+        if sibling < len(level): proof.append(('l' if sibling < n else 'r', level[sibling]))
+        n //= 2
+    return proof
+
+
+class MerkleBatchSigner(object):
+    '''Collects data to sign over "window" seconds (or up to "max_size" items),
+        signing only the root of a merkle tree built over these with wrapped signer.
+        Each signed item gets the same signature and its own inclusion proof.'''
+
+    batched = True
+
+    def __init__(self, signer, window, max_size=None):
+        self.signer, self.window, self.max_size = signer, window, max_size
+        self.scheme = 'merkle-{}'.format(signer.scheme)
+        self.batch, self.timer = list(), None
+
+    def sign(self, data):
+        'Returns deferred, firing with (signature, proof) tuple, once batch is signed.'
+        deferred = defer.Deferred()
+        self.batch.append((deferred, data))
+        if self.max_size and len(self.batch) >= self.max_size: self.signBatch()
+        elif not self.timer: self.timer = reactor.callLater(self.window, self.signBatch)
+        return deferred
+
+    def signBatch(self):
+        if self.timer and self.timer.active(): self.timer.cancel()
+        batch, self.batch, self.timer = self.batch, list(), None
+        if not batch: return
+        levels = merkle_levels(merkle_leaf(data) for deferred, data in batch)
+        try: signature = self.signer.sign(levels[-1][0])
+        except Exception:
+            err = Failure()
+            for deferred, data in batch: deferred.errback(err)
+            return
+        log.debug('Signed batch of %s response(s)', len(batch))
+        metric_batches.inc()
+        metric_batched.add(len(batch))
+        for n, (deferred, data) in enumerate(batch):
+            deferred.callback((signature, merkle_proof(levels, n)))
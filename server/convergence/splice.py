@@ -0,0 +1,201 @@
+#-*- coding: utf-8 -*-
+
+'''
+Relay for established proxy tunnels, that moves data between two sockets
+via splice(2) through kernel pipes, without it ever being copied into python.
+
+Linux-only, as it depends on splice(2) and epoll,
+with the former called via ctypes (os.splice is python3-only).
+Sockets are handled by a small pool of worker threads,
+each running its own epoll loop for all tunnels assigned to it.
+'''
+
+from twisted.internet import reactor
+
+import os, sys, errno, fcntl, socket, select, threading, itertools as it, logging
+
+log = logging.getLogger(__name__)
+
+
+SPLICE_F_MOVE, SPLICE_F_NONBLOCK = 1, 2
+F_SETPIPE_SZ, F_GETPIPE_SZ = 1031, 1032
+
+_splice = None
+
+def get_splice():
+    global _splice
+    if _splice is None:
+        if not sys.platform.startswith('linux') or not hasattr(select, 'epoll'):
+            raise OSError('splice(2) relay is only supported on linux')
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        func = libc.splice
+        func.argtypes = [ ctypes.c_int, ctypes.c_void_p,
+            ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint ]
+        func.restype = ctypes.c_ssize_t
+
+        def _splice(fd_in, fd_out, size):
+            n = func(fd_in, None, fd_out, None, size, SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err == errno.EAGAIN: return None
+                raise OSError(err, os.strerror(err))
+            return n
+    return _splice
+
+
+class SplicePump(object):
+    'Moves data in one direction (src -> pipe -> dst), starting with prefix string, if any.'
+
+    def __init__(self, src, dst, prefix, pipe_size):
+        self.src, self.dst, self.prefix = src, dst, prefix
+        self.pipe_r, self.pipe_w = os.pipe()
+        try: fcntl.fcntl(self.pipe_w, F_SETPIPE_SZ, pipe_size)
+        except IOError: pass # can be limited by /proc/sys/fs/pipe-max-size
+        try: self.pipe_size = fcntl.fcntl(self.pipe_w, F_GETPIPE_SZ)
+        except IOError: self.pipe_size = 2**16
+        self.buffered = self.bytes = 0
+        self.eof = self.shut = False
+
+    @property
+    def wants_read(self):
+        return not self.eof and self.buffered < self.pipe_size
+
+    @property
+    def wants_write(self):
+        return bool(self.prefix or self.buffered)
+
+    def run(self, splice):
+        'Move as much data as possible without blocking.'
+        src, dst = self.src.fileno(), self.dst.fileno()
+        while True:
+            if self.prefix:
+                try: n = os.write(dst, self.prefix)
+                except OSError as err:
+                    if err.errno != errno.EAGAIN: raise
+                    break
+                self.prefix = self.prefix[n:]
+                continue
+            progress = False
+            if self.wants_read:
+                n = splice(src, self.pipe_w, self.pipe_size - self.buffered)
+                if n == 0: self.eof = True
+                elif n:
+                    self.buffered += n
+                    self.bytes += n
+                    progress = True
+            if self.buffered:
+                n = splice(self.pipe_r, dst, self.buffered)
+                if n:
+                    self.buffered -= n
+                    progress = True
+            if not progress: break
+        if self.eof and not self.wants_write and not self.shut:
+            self.dst.shutdown(socket.SHUT_WR)
+            self.shut = True
+
+    def close(self):
+        for fd in self.pipe_r, self.pipe_w: os.close(fd)
+
+
+class SpliceTunnel(object):
+
+    def __init__(self, client, notary, prefix_up, prefix_down, pipe_size, callback):
+        self.client, self.notary, self.callback = client, notary, callback
+        self.up = SplicePump(client, notary, prefix_up, pipe_size)
+        self.down = SplicePump(notary, client, prefix_down, pipe_size)
+
+    @property
+    def done(self):
+        return self.up.shut and self.down.shut
+
+    def events(self, sock):
+        pump_in, pump_out = (self.up, self.down) if sock is self.client else (self.down, self.up)
+        mask = 0
+        if pump_in.wants_read: mask |= select.EPOLLIN
+        if pump_out.wants_write: mask |= select.EPOLLOUT
+        return mask
+
+
+class SpliceWorker(threading.Thread):
+
+    def __init__(self, name, pipe_size):
+        super(SpliceWorker, self).__init__(name=name)
+        self.daemon, self.pipe_size = True, pipe_size
+        self.splice, self.poller = get_splice(), select.epoll()
+        self.queue, self.queue_lock = list(), threading.Lock()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.poller.register(self.wakeup_r, select.EPOLLIN)
+        self.tunnels, self.running = dict(), True # fd -> tunnel
+
+    def add(self, tunnel):
+        with self.queue_lock: self.queue.append(tunnel)
+        os.write(self.wakeup_w, b'.')
+
+    def stop(self):
+        self.running = False
+        os.write(self.wakeup_w, b'.')
+
+    def _finish(self, tunnel, err=None):
+        for sock in tunnel.client, tunnel.notary:
+            try: self.poller.unregister(sock.fileno())
+            except (IOError, OSError): pass
+            self.tunnels.pop(sock.fileno(), None)
+        for pump in tunnel.up, tunnel.down: pump.close()
+        reactor.callFromThread(tunnel.callback, tunnel.up.bytes, tunnel.down.bytes, err)
+
+    def _process(self, tunnel, register=False, hangup=False):
+        try:
+            for pump in tunnel.up, tunnel.down: pump.run(self.splice)
+            # Hangup gets reported until socket is unregistered, and can't be recovered from
+            if tunnel.done or hangup: return self._finish(tunnel)
+            for sock in tunnel.client, tunnel.notary:
+                (self.poller.register if register else self.poller.modify)(
+                    sock.fileno(), tunnel.events(sock) )
+        except (IOError, OSError, socket.error) as err: self._finish(tunnel, err)
+
+    def run(self):
+        while self.running:
+            try: events = self.poller.poll()
+            except IOError as err:
+                if err.errno == errno.EINTR: continue
+                raise
+            for fd, event in events:
+                if fd == self.wakeup_r:
+                    os.read(self.wakeup_r, 4096)
+                    with self.queue_lock: queue, self.queue = self.queue, list()
+                    for tunnel in queue:
+                        for sock in tunnel.client, tunnel.notary: self.tunnels[sock.fileno()] = tunnel
+                        self._process(tunnel, register=True)
+                    continue
+                tunnel = self.tunnels.get(fd)
+                if tunnel:
+                    self._process( tunnel,
+                        hangup=bool(event & (select.EPOLLHUP | select.EPOLLERR)) )
+        for tunnel in set(self.tunnels.viewvalues()):
+            self._finish(tunnel, OSError('Relay stopped'))
+
+
+class SpliceRelay(object):
+
+    def __init__(self, threads=1, pipe_size=2**16):
+        get_splice() # make sure it's available
+        self.workers = list( SpliceWorker('splice-relay-{}'.format(n), pipe_size)
+            for n in xrange(threads) )
+        self.worker_cycle = it.cycle(self.workers)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def relay(self, client, notary, callback, prefix_up='', prefix_down=''):
+        '''Pass two connected sockets (with reactor no longer watching them) to relay.
+            Prefixes will be sent before anything read from the other socket.
+            callback(bytes_up, bytes_down, error) will be called via reactor when tunnel is closed.
+            Returns SpliceTunnel object, which has byte counters updated as data passes through.'''
+        worker = next(self.worker_cycle)
+        if not worker.is_alive(): worker.start()
+        tunnel = SpliceTunnel(client, notary, prefix_up, prefix_down, worker.pipe_size, callback)
+        worker.add(tunnel)
+        return tunnel
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.is_alive(): worker.stop()
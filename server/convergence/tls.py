@@ -0,0 +1,142 @@
+#-*- coding: utf-8 -*-
+
+'''
+Server-side TLS context for notary endpoints, with session caching,
+session tickets and cipher/curve configuration.
+
+Session-ticket keys are derived from a shared secret (if any) and current
+rotation period number, so that any number of notary processes with the
+same secret file will accept tickets issued by each other,
+without having to pass the keys between these.
+'''
+
+from twisted.internet import ssl
+from twisted.internet.task import LoopingCall
+
+from OpenSSL import SSL, crypto
+
+from convergence import metrics
+
+import os, time, hmac, hashlib, logging
+
+log = logging.getLogger(__name__)
+
+metric_handshakes = metrics.counter( 'tls_handshakes_total',
+    'Completed TLS handshakes on notary endpoints (session=new|resumed).', ['session'] )
+
+
+# Not exposed in pyOpenSSL API, used via cffi bindings where available
+# Length of the keys blob depends on OpenSSL version (48B for 1.0.x, 80B for 1.1.0+),
+#  and is queried via GET ctrl with NULL pointer, as any other length is rejected
+SSL_CTRL_GET_TLSEXT_TICKET_KEYS = 58
+SSL_CTRL_SET_TLSEXT_TICKET_KEYS = 59
+
+try: from OpenSSL._util import lib as _lib, ffi as _ffi
+except ImportError: _lib = _ffi = None
+
+ciphers_default = ':'.join([
+    'ECDHE+AESGCM', 'ECDHE+CHACHA20', 'DHE+AESGCM',
+    'ECDHE+AES', 'DHE+AES', '!aNULL', '!eNULL', '!MD5', '!DSS', '!RC4', '!3DES' ])
+
+
+class TicketKeysError(Exception): pass
+
+
+class NotaryContextFactory(ssl.ContextFactory):
+
+    isClient = False
+
+    def __init__( self, cert, cert_key, ciphers=None, curve=None,
+            session_cache=20480, session_timeout=3600,
+            ticket_rotation=12 * 3600, ticket_secret=None ):
+        self.cert, self.cert_key = cert, cert_key
+        self.ciphers, self.curve = ciphers, curve
+        self.session_cache, self.session_timeout = session_cache, session_timeout
+        self.ticket_rotation, self.ticket_secret = ticket_rotation, ticket_secret
+        if self.ticket_rotation and not self.ticket_secret:
+            log.debug('No shared secret for TLS session tickets, using random (per-process) one')
+            self.ticket_secret = os.urandom(32)
+        self.ticket_epoch, self.ticket_loop, self.ticket_keys_len = None, None, None
+        self._context = self.buildContext()
+
+    def buildContext(self):
+        ctx = SSL.Context(SSL.SSLv23_METHOD)
+        ctx.set_options( SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3
+            | SSL.OP_NO_COMPRESSION | SSL.OP_CIPHER_SERVER_PREFERENCE )
+        ctx.use_certificate_chain_file(self.cert)
+        ctx.use_privatekey_file(self.cert_key)
+        ctx.set_cipher_list(self.ciphers or ciphers_default)
+        if self.curve: ctx.set_tmp_ecdh(crypto.get_elliptic_curve(self.curve))
+
+        if self.session_cache:
+            ctx.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+            ctx.set_session_id(b'convergence-notary')
+            ctx.set_timeout(self.session_timeout)
+            try: _lib.SSL_CTX_sess_set_cache_size(ctx._context, self.session_cache)
+            except AttributeError:
+                log.debug('Unable to set TLS session cache size, using OpenSSL default')
+        else: ctx.set_session_cache_mode(SSL.SESS_CACHE_OFF)
+
+        if not self.ticket_rotation: ctx.set_options(SSL.OP_NO_TICKET)
+        elif _lib is None or not hasattr(_lib, 'SSL_CTX_ctrl'):
+            log.warning( 'Unable to set TLS session-ticket keys with'
+                ' installed pyOpenSSL, these will not be shared or rotated' )
+            self.ticket_rotation = None
+        else:
+            self.ticket_keys_len = _lib.SSL_CTX_ctrl(
+                ctx._context, SSL_CTRL_GET_TLSEXT_TICKET_KEYS, 0, _ffi.NULL )
+            if self.ticket_keys_len <= 0:
+                raise TicketKeysError('Failed to get TLS session-ticket keys length from OpenSSL')
+            # First keys are set right here, so that any errors there will abort startup
+            self.rotateTicketKeys(ctx)
+            self.ticket_loop = LoopingCall(self.rotateTicketKeys, ctx)
+            self.ticket_loop.start(min(60, self.ticket_rotation), now=False)\
+                .addErrback(self.rotateTicketKeysError)
+
+        ctx.set_info_callback(self.handshakeCallback)
+        return ctx
+
+    def ticketKeys(self, epoch, length):
+        'Derives "length" bytes of ticket keys for the specified rotation period number.'
+        keys, block = '', 0
+        while len(keys) < length:
+            keys += hmac.new( self.ticket_secret, 'convergence-ticket-keys:{}{}'.format(
+                epoch, ':{}'.format(block) if block else '' ), hashlib.sha512 ).digest()
+            block += 1
+        return keys[:length]
+
+    def rotateTicketKeys(self, ctx):
+        epoch = int(time.time() // self.ticket_rotation)
+        if epoch == self.ticket_epoch: return
+        log.debug('Setting TLS session-ticket keys for period: %s', epoch)
+        # Only one key can be set via this API, so tickets from previous period
+        #  will fall back to full handshake, unless session cache has them as well
+        keys = _ffi.new('unsigned char[]', self.ticketKeys(epoch, self.ticket_keys_len))
+        if not _lib.SSL_CTX_ctrl( ctx._context,
+                SSL_CTRL_SET_TLSEXT_TICKET_KEYS, self.ticket_keys_len, keys ):
+            raise TicketKeysError( 'Failed to set TLS session-ticket'
+                ' keys ({} bytes)'.format(self.ticket_keys_len) )
+        self.ticket_epoch = epoch
+
+    def rotateTicketKeysError(self, err):
+        log.error( 'TLS session-ticket keys rotation failed, tickets will'
+            ' no longer be rotated or shared: %s', err.getErrorMessage() )
+
+    def handshakeCallback(self, conn, where, ret):
+        if not where & SSL.SSL_CB_HANDSHAKE_DONE: return
+        try: reused = conn.session_reused()
+        except AttributeError:
+            try: reused = _lib.SSL_session_reused(conn._ssl)
+            except AttributeError: reused = None
+        if reused is not None: metric_handshakes.inc('resumed' if reused else 'new')
+
+    def getContext(self):
+        return self._context
+
+
+def read_secret(path):
+    'Reads shared secret from a file, which must be at least 32 bytes long.'
+    with open(path, 'rb') as src: secret = src.read()
+    if len(secret) < 32:
+        raise ValueError('TLS session-ticket secret file must contain at least 32 bytes: {}'.format(path))
+    return secret
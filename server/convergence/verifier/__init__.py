@@ -18,6 +18,8 @@
 # USA
 #
 
+from twisted.internet import defer
+
 from os.path import dirname, join
 
 
@@ -60,6 +62,28 @@ class Verifier(object):
         raise NotImplementedError('Abstract method!')
 
 
+    def verify_many(self, targets):
+        '''
+        Verify a batch of targets at once.
+
+        Optional method for backends that can do better than a number of
+        separate verify() calls (e.g. pipeline or de-duplicate queries).
+        Default implementation simply fans out each target to verify().
+
+        :Parameters:
+        - `targets` (sequence) - (host, port, address, fingerprint, log)
+          tuples, each with the same arguments as passed to verify().
+
+        :Returns Type:
+        Deferred, with callback getting the list of (success, result)
+        tuples in the same order as targets (same as with DeferredList),
+        where result is either (responseCode, fingerprintToCache) or a Failure.
+        '''
+        return defer.DeferredList(
+            list(defer.maybeDeferred(self.verify, *target) for target in targets),
+            consumeErrors=True )
+
+
     infonode_template = join(dirname(__file__), 'InfoNode.html')
 
     def getInfoNode(self, request):
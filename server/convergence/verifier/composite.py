@@ -0,0 +1,126 @@
+#-*- coding: utf-8 -*-
+
+from convergence.verifier import Verifier, OptionsError
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web.server import escape
+
+from collections import defaultdict
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class CompositeVerifier(Verifier):
+    '''
+    Verifier that runs several other backends concurrently
+    and combines their results according to specified policy.
+    '''
+
+    policies = 'first', 'all'
+
+    description = (
+        'Run checks with several other verifier backends concurrently,'
+        ' deciding on the result according to the specified policy.'
+        ' Pending checks are cancelled as soon as the outcome is known.' )
+
+    options_description = '\n'.join([
+        'List of sub-backends with their options and an optional policy,'
+            ' separated by semicolons, in "[policy=<policy>;] name1[:options1]; name2[:options2] ..." format.',
+        'Policy can be "first" (default, first positive result wins),'
+            ' "all" (all results must be positive and agree on fingerprint)'
+            ' or a number k (k-of-n, at least k positive results must agree on fingerprint).',
+        'Example: policy=all; perspective: verify_ca; dns: catalog.example.com' ])
+
+    def __init__(self, opts):
+        if not opts:
+            raise OptionsError('At least one sub-backend must be specified in backend options.')
+        from convergence.core import get_backend_list
+        backends = get_backend_list()
+
+        policy, self.backends = 'first', list()
+        for spec in opts.split(';'):
+            spec = spec.strip()
+            if not spec: continue
+            if spec.startswith('policy='):
+                policy = spec.split('=', 1)[1].strip()
+                if policy.isdigit(): policy = int(policy)
+                elif policy not in self.policies:
+                    raise OptionsError( 'Unknown policy {!r}, must be one of: {}, or a number.'\
+                        .format(policy, ', '.join(self.policies)) )
+                continue
+            name, sub_opts = (spec.split(':', 1) + [''])[:2]
+            name, sub_opts = name.strip(), sub_opts.strip() or None
+            if name == 'composite':
+                raise OptionsError('Nested composite backends are not supported.')
+            try: backend = backends[name]
+            except KeyError:
+                raise OptionsError( 'Invalid sub-backend (available: {}): {}'\
+                    .format(', '.join(sorted(set(backends).difference(['composite']))), name) )
+            try: backend = backend.load().verifier(sub_opts)
+            except OptionsError as err:
+                raise OptionsError('Sub-backend {!r} options error: {}'.format(name, err.message))
+            self.backends.append((name, backend))
+        if not self.backends:
+            raise OptionsError('At least one sub-backend must be specified in backend options.')
+
+        self.policy = policy
+        if policy == 'first': self.quorum = 1
+        elif policy == 'all': self.quorum = len(self.backends)
+        elif not 0 < policy <= len(self.backends):
+            raise OptionsError( 'Policy k-of-n value ({}) must be'
+                ' in 1-{} range.'.format(policy, len(self.backends)) )
+        else: self.quorum = policy
+
+        log.debug( 'Sub-backends: %s, policy: %s (quorum: %s)',
+            ', '.join(name for name, backend in self.backends), self.policy, self.quorum )
+
+    def verify(self, host, port, address, fingerprint, log):
+        checks, votes, negative, failures = list(), defaultdict(int), list(), list()
+        result = defer.Deferred(lambda d: self._cancel(checks))
+
+        def _finish(res):
+            result.callback(res)
+            self._cancel(checks)
+
+        def _check_done(res, name):
+            if result.called: return # cancelled or decided without it
+            if isinstance(res, Failure):
+                log.debug('Sub-backend %s error: %s', name, res.getErrorMessage())
+                failures.append(res)
+            else:
+                code, fingerprintSeen = res
+                log.debug('Sub-backend %s result: %s %s', name, code, fingerprintSeen)
+                if code == 200:
+                    votes[fingerprintSeen] += 1
+                    if votes[fingerprintSeen] >= self.quorum: return _finish(res)
+                else: negative.append(fingerprintSeen)
+
+            pending = len(self.backends) - len(failures) - len(negative) - sum(votes.viewvalues())
+            if max(votes.viewvalues() or [0]) + pending >= self.quorum: return
+            if len(failures) == len(self.backends): return _finish(failures[0])
+            # Only pass fingerprint to cache if all backends that returned one agree on it
+            seen = set(votes).union(negative).difference([None])
+            _finish((409, seen.pop() if len(seen) == 1 else None))
+
+        for name, backend in self.backends:
+            if result.called: break
+            check = defer.maybeDeferred(backend.verify, host, port, address, fingerprint, log)
+            checks.append(check)
+            check.addBoth(_check_done, name)
+
+        return result
+
+    def _cancel(self, checks):
+        for check in checks:
+            if not check.called: check.cancel()
+
+    def getDescription(self):
+        description = '<p>Notary Type: {}, policy: {}</p>'.format(self.__class__.__name__, self.policy)
+        return description + '\n'.join(
+            '<h4>{}</h4>\n{}'.format(escape(name), backend.getDescription())
+            for name, backend in self.backends )
+
+
+verifier = CompositeVerifier
@@ -20,6 +20,8 @@
 
 from convergence.verifier import Verifier, OptionsError
 
+from twisted.internet import defer
+from twisted.python.failure import Failure
 import twisted.names.client
 import logging
 
@@ -49,14 +51,37 @@ class DNSVerifier(Verifier):
         log.debug('Catalog resolution failure: ' + str(error))
         return (409, None)
 
-    def verify(self, host, port, address, fingerprint, log):
+    def _lookup(self, fingerprint):
         formatted = ''.join(fingerprint.split(':')).lower()
-        deferred = twisted.names.client.lookupText('%s.%s' % (formatted, self.host))
+        return twisted.names.client.lookupText('%s.%s' % (formatted, self.host))
+
+    def verify(self, host, port, address, fingerprint, log):
+        deferred = self._lookup(fingerprint)
 
         deferred.addCallback(self._dnsLookupComplete, fingerprint, log)
         deferred.addErrback(self._dnsLookupError, log)
 
         return deferred
 
+    def verify_many(self, targets):
+        # Same fingerprint (e.g. for different hosts sharing
+        #  a certificate) only gets queried once for the whole batch
+        results, waiters = list(), dict()
+        for host, port, address, fingerprint, log in targets:
+            deferred = defer.Deferred()
+            deferred.addCallback(self._dnsLookupComplete, fingerprint, log)
+            deferred.addErrback(self._dnsLookupError, log)
+            waiters.setdefault(fingerprint, list()).append(deferred)
+            results.append(deferred)
+
+        def _fanout(result, waiting):
+            for deferred in waiting:
+                if isinstance(result, Failure): deferred.errback(result)
+                else: deferred.callback(result)
+        for fingerprint, waiting in waiters.viewitems():
+            defer.maybeDeferred(self._lookup, fingerprint).addBoth(_fanout, waiting)
+
+        return defer.DeferredList(results, consumeErrors=True)
+
 
 verifier = DNSVerifier
@@ -27,7 +27,8 @@ from OpenSSL.SSL import (
     Context, SSLv23_METHOD, TLSv1_METHOD,
     VERIFY_PEER, VERIFY_FAIL_IF_NO_PEER_CERT, OP_NO_SSLv2 )
 
-import os, re, logging
+from collections import OrderedDict
+import os, re, socket, logging
 
 log = logging.getLogger(__name__)
 
@@ -52,7 +53,7 @@ class NetworkPerspectiveVerifier(Verifier):
     match across network perspective.
     '''
 
-    opts_default = dict(verify_ca=False, bind=None)
+    opts_default = dict(verify_ca=False, bind=None, san_cache=1024)
 
     description = (
         'Check if remote presents the same certificate to the notary as it did to client,'
@@ -64,6 +65,8 @@ class NetworkPerspectiveVerifier(Verifier):
         'Boolean flags can be prefixed with "-" to disable them,'
             ' otherwise will be enabled if specified without a value.',
         'Example: verify_ca bind=10.1.2.3',
+        'san_cache is a number of certificates to keep parsed'
+            ' subjectAltName entries for, with verify_ca (0 - disable).',
         'Default options: {}.'.format(
             ', '.join(map('{0[0]}={0[1]}'.format, opts_default.viewitems())) or '(none)' ) ])
 
@@ -99,19 +102,22 @@ class NetworkPerspectiveVerifier(Verifier):
             bind = self.opts['bind'].rsplit(':', 1)
             self.opts['bind'] = (bind[0], int(bind[1])) if len(bind) != 1 else (bind[0], 0)
 
+        self.matchers = SANMatcherCache(self.opts['san_cache'])
+
         log.debug('Options: %s', self.opts)
 
     def verify(self, host, port, address, fingerprint, log):
-        deferred = defer.Deferred()
+        # Cancelling the check (e.g. from composite backend) drops the connection
+        deferred = defer.Deferred(lambda d: connector.disconnect())
         factory_ctx = CertificateContextFactory(
             deferred, fingerprint, log=log, verify_ca=self.opts.get('verify_ca'),
             # Don't use SNI/matching for IP addresses
-            hostname=host if not re.search(r'^(\d+\.){3}\d+$', host) else None )
+            hostname=host if not _is_address(host) else None, matchers=self.matchers )
         factory = CertificateFetcherClientFactory(deferred, host, port, factory_ctx, log)
 
         log.debug('Fetching certificate from: %s:%s', host, port)
 
-        reactor.connectSSL( address or host, port,
+        connector = reactor.connectSSL( address or host, port,
             factory, factory_ctx, bindAddress=self.opts['bind'] )
         return deferred
 
@@ -140,6 +146,7 @@ class CertificateFetcherClientFactory(ClientFactory, object):
         return p
 
     def clientConnectionFailed(self, connector, reason):
+        if self.deferred.called: return
         try:
             raise CertificateFetcherError(
                 'Connection to ({!r}, {!r}) failed - {}'\
@@ -170,34 +177,95 @@ def _dnsname_to_pat(dn):
             pats.append(frag.replace(r'\*', '[^.]*'))
     return re.compile(r'\A' + r'\.'.join(pats) + r'\Z', re.IGNORECASE)
 
-def _addr_to_tuple(addr):
-    try: return map(int, addr.split('.'))
-    except ValueError: return None
-
-def match_x509(x509, hostname=None, address=None):
-    'match_hostname() function from Python 3.2.2, adapted to work with pyOpenSSL.'
-    if address:
-        if ':' in address: raise ValueError('IPv6 addresses ({}) are not supported'.format(address))
-        address = _addr_to_tuple(address)
-    patterns = list()
-    for ext in xrange(x509.get_extension_count()):
-        ext = x509.get_extension(ext)
-        if ext.get_short_name() == 'subjectAltName':
+def _addr_to_bytes(addr):
+    'Returns packed IPv4/IPv6 address, so that different notations of it compare equal.'
+    for family in socket.AF_INET, socket.AF_INET6:
+        try: return socket.inet_pton(family, addr.strip().strip('[]'))
+        except (socket.error, ValueError): pass
+    return None
+
+def _is_address(host):
+    return _addr_to_bytes(host) is not None
+
+
+class SANMatcher(object):
+    '''Hostname/address matcher for a certificate, built from its subjectAltName entries once.
+        Plain names and "*.some.domain" wildcards (vast majority of these) are
+        checked via set lookups, anything more exotic falls back to regexps.'''
+
+    def __init__(self, x509):
+        self.names, self.wildcards, self.patterns = set(), set(), list()
+        self.addresses, self.entries_dns, self.entries_ip = set(), list(), list()
+        for ext in xrange(x509.get_extension_count()):
+            ext = x509.get_extension(ext)
+            if ext.get_short_name() != 'subjectAltName': continue
             for val in str(ext).split(','):
                 val = val.strip()
-                if hostname and val.startswith('DNS:'):
-                    if _dnsname_to_pat(val[4:]).match(hostname): return
-                    patterns.append(val[4:])
-                if address and val.startswith('IP:'):
-                    if address == _addr_to_tuple(val[3:]): return
-                    patterns.append(val[3:])
-    if not patterns:
-        val = x509.get_subject().commonName
-        if hostname and _dnsname_to_pat(val).match(hostname): return
-        if address and address == _addr_to_tuple(val): return
-        patterns.append(val)
-    raise CertificateError(( 'Hostname/address {!r}/{!r} does not'
-        ' match any of: {}' ).format(hostname, address, ', '.join(map(repr, patterns))))
+                if val.startswith('DNS:'):
+                    name = val[4:].rstrip('.').lower()
+                    self.entries_dns.append(val[4:])
+                    if '*' not in name: self.names.add(name)
+                    elif name.startswith('*.') and '*' not in name[2:]: self.wildcards.add(name[2:])
+                    else: self.patterns.append(_dnsname_to_pat(name))
+                else:
+                    # OpenSSL prints these as "IP Address:...", IPv6 ones in uncompressed form
+                    for prefix in 'IP:', 'IP Address:':
+                        if not val.startswith(prefix): continue
+                        self.entries_ip.append(val[len(prefix):])
+                        addr = _addr_to_bytes(val[len(prefix):])
+                        if addr: self.addresses.add(addr)
+        self.cn = x509.get_subject().commonName
+
+    def matchHostname(self, hostname):
+        hostname = hostname.rstrip('.').lower()
+        if hostname in self.names: return True
+        label, _, parent = hostname.partition('.')
+        if label and parent in self.wildcards: return True
+        return any(pat.match(hostname) for pat in self.patterns)
+
+    def match(self, hostname=None, address=None):
+        if address: address = _addr_to_bytes(address)
+        if hostname and self.entries_dns:
+            if self.matchHostname(hostname): return
+        if address and self.entries_ip:
+            if address in self.addresses: return
+        patterns = (self.entries_dns if hostname else list())\
+            + (self.entries_ip if address else list())
+        if not patterns:
+            val = self.cn
+            if val:
+                if hostname and _dnsname_to_pat(val).match(hostname): return
+                if address and address == _addr_to_bytes(val): return
+            patterns.append(val)
+        raise CertificateError(( 'Hostname/address {!r}/{!r} does not'
+            ' match any of: {}' ).format(hostname, address and socket.inet_ntop(
+                socket.AF_INET if len(address) == 4 else socket.AF_INET6, address ),
+            ', '.join(map(repr, patterns))))
+
+
+class SANMatcherCache(object):
+    'LRU cache of SANMatcher objects, keyed by certificate digest.'
+
+    def __init__(self, size=1024):
+        self.size, self.matchers = size, OrderedDict()
+
+    def get(self, x509, digest=None):
+        if not self.size: return SANMatcher(x509)
+        if digest is None: digest = x509.digest('sha1')
+        matcher = self.matchers.pop(digest, None)
+        if matcher is None:
+            matcher = SANMatcher(x509)
+            while len(self.matchers) >= self.size: self.matchers.popitem(last=False)
+        self.matchers[digest] = matcher
+        return matcher
+
+
+def match_x509(x509, hostname=None, address=None, matchers=None, digest=None):
+    '''match_hostname() function from Python 3.2.2, adapted to work with pyOpenSSL.
+        Raises CertificateError if neither hostname nor address match the certificate.
+        SANMatcherCache can be passed to reuse parsed SANs for same cert ("digest" - its sha1).'''
+    matcher = SANMatcher(x509) if matchers is None else matchers.get(x509, digest)
+    matcher.match(hostname, address)
 
 
 class CertificateContextFactory(ssl.ContextFactory):
@@ -205,9 +273,10 @@ class CertificateContextFactory(ssl.ContextFactory):
     isClient = True
     hostname = address = None
 
-    def __init__(self, deferred, fingerprint, log, verify_ca, hostname=None):
+    def __init__(self, deferred, fingerprint, log, verify_ca, hostname=None, matchers=None):
         self.deferred, self.fingerprint, self.log = deferred, fingerprint, log
         self.verify_ca, self.hostname, self.sni_sent = verify_ca, hostname, False
+        self.matchers = matchers
 
     def handshake_callback(self, conn, stage, errno):
         if not self.sni_sent and self.hostname:
@@ -224,6 +293,7 @@ class CertificateContextFactory(ssl.ContextFactory):
 
     def verifyCertificate(self, connection, x509, errno, depth, preverify_ok):
         if depth != 0: return True
+        if self.deferred.called: return False # cancelled
         self.log.debug('Verifying certificate (ca check: %s)', preverify_ok)
 
         try:
@@ -232,7 +302,8 @@ class CertificateContextFactory(ssl.ContextFactory):
 
             if fingerprintSeen == self.fingerprint:
                 if self.verify_ca and (self.hostname or self.address):
-                    try: match_x509(x509, self.hostname, self.address)
+                    try: match_x509( x509, self.hostname,
+                        self.address, self.matchers, fingerprintSeen )
                     except CertificateError as err:
                         self.log.debug('Failed to match certificate against hostname: %s', err)
                         fingerprintSeen = None # so that it won't get cached
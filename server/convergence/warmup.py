@@ -0,0 +1,113 @@
+#-*- coding: utf-8 -*-
+
+'''
+Cache warm-up on notary startup.
+
+Looks up records for a number of hot locations - either listed in a file
+(saved on shutdown of a previous run) or most recently updated in database,
+which fills SQLite/OS page caches and in-memory ETag cache for these,
+optionally delaying start of notary listeners until that is done.
+'''
+
+from twisted.application import service
+from twisted.internet import reactor, defer
+
+import os, time, logging
+
+log = logging.getLogger(__name__)
+
+
+class Warmup(object):
+
+    progress_interval = 5.0
+
+    def __init__(self, database, etags, count, path=None, concurrency=1):
+        self.database, self.etags, self.count, self.path = database, etags, count, path
+        self.concurrency, self.done = concurrency, False
+
+    def locationsFromFile(self):
+        with open(self.path) as src:
+            return list(line.strip() for line in src if line.strip())[:self.count]
+
+    def locationsFromDatabase(self):
+        return self.database.readConnection.runQuery(
+            'SELECT location FROM fingerprints GROUP BY location'
+            ' ORDER BY MAX(timestamp_finish) DESC LIMIT ?', (self.count,) )\
+            .addCallback(lambda rows: list(row[0].encode('utf-8') for row in rows))
+
+    @defer.inlineCallbacks
+    def run(self):
+        ts = time.time()
+        try:
+            if self.path and os.path.exists(self.path):
+                locations, source = self.locationsFromFile(), self.path
+            else: locations, source = (yield self.locationsFromDatabase()), 'database'
+        except Exception as err:
+            log.error('Failed to get list of locations to warm up cache for: %s', err)
+            self.done = True
+            defer.returnValue(None)
+        log.info('Warming up cache for %s location(s) from %s', len(locations), source)
+
+        semaphore, progress = defer.DeferredSemaphore(self.concurrency), dict(n=0, ts=time.time())
+        def _lookup(location):
+            host, port = location.rsplit(':', 1)
+            return self.database.getRecordsFor(host, port).addCallback(_cache, host, port)
+        def _cache(recordRows, host, port):
+            if recordRows: self.etags.set((host, port), recordRows)
+            progress['n'] += 1
+            if time.time() - progress['ts'] >= self.progress_interval:
+                log.info( 'Cache warm-up: %s/%s location(s)'
+                    ' done in %.1fs', progress['n'], len(locations), time.time() - ts )
+                progress['ts'] = time.time()
+        results = yield defer.DeferredList(list(
+            semaphore.run(_lookup, location) for location in locations ), consumeErrors=True)
+        errors = sum(1 for success, result in results if not success)
+        if errors: log.warn('Cache warm-up: failed to look up %s location(s)', errors)
+
+        self.done = True
+        log.info( 'Cache warm-up finished in %.1fs (%s location(s))',
+            time.time() - ts, len(locations) - errors )
+
+    def save(self):
+        'Writes up to "count" most recently requested locations to the file, if any.'
+        if not self.path: return
+        keys = list(self.etags.entries)[::-1][:self.count]
+        if not keys: return
+        tmp = '{}.tmp'.format(self.path)
+        try:
+            with open(tmp, 'w') as dst:
+                for host, port in keys: dst.write('{}:{}\n'.format(host, port))
+            os.rename(tmp, self.path)
+        except (OSError, IOError) as err:
+            log.error('Failed to save warm-up locations to %s: %s', self.path, err)
+        else: log.info('Saved %s location(s) for cache warm-up to %s', len(keys), self.path)
+
+
+class WarmupService(service.MultiService):
+    '''Starts child services (e.g. listeners) after cache warm-up
+        is finished or "delay" seconds have passed, whichever is first.'''
+
+    def __init__(self, warmup, delay):
+        service.MultiService.__init__(self)
+        self.warmup, self.delay = warmup, delay
+        self.timer, self.children_started = None, False
+
+    def startService(self):
+        service.Service.startService(self)
+        finished = self.warmup.run()
+        if not self.delay: return self.startChildren()
+        self.timer = reactor.callLater(self.delay, self.startChildren)
+        finished.addBoth(lambda result: self.startChildren())
+
+    def startChildren(self):
+        if self.timer and self.timer.active(): self.timer.cancel()
+        if self.children_started or not self.running: return
+        if not self.warmup.done:
+            log.info('Starting listeners, cache warm-up continues in the background')
+        self.children_started = True
+        for svc in self: svc.startService()
+
+    def stopService(self):
+        if self.timer and self.timer.active(): self.timer.cancel()
+        if self.children_started: return service.MultiService.stopService(self)
+        service.Service.stopService(self)
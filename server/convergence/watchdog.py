@@ -0,0 +1,76 @@
+#-*- coding: utf-8 -*-
+
+'''
+Watchdog for reactor stalls - anything blocking the event loop for too long.
+
+Lag is measured as a drift of periodic LoopingCall from its schedule,
+while a separate thread checks when the loop last ticked, and samples
+the stack of the reactor thread if it has been stuck for longer than threshold.
+'''
+
+from twisted.internet.task import LoopingCall
+
+from convergence import metrics
+
+import sys, time, threading, traceback, logging
+
+log = logging.getLogger(__name__)
+
+metric_lag = metrics.histogram( 'reactor_lag_seconds',
+    'Delay of periodic reactor watchdog calls from their schedule.' )
+metric_stalls = metrics.counter( 'reactor_stalls_total',
+    'Number of times reactor was blocked for longer than watchdog threshold.' )
+metric_samples = metrics.counter( 'reactor_stall_samples_total',
+    'Stack samples taken from blocked reactor thread, by innermost frame.', ['location'] )
+
+
+class Watchdog(object):
+
+    def __init__(self, threshold=1.0, interval=0.1):
+        self.threshold, self.interval = threshold, interval
+        self.loop = LoopingCall(self.tick)
+        self.thread, self.reactor_thread = None, None
+        self.last_tick = self.stalled = None
+
+    def start(self):
+        'Must be called from the reactor thread.'
+        self.reactor_thread = threading.current_thread().ident
+        self.last_tick = time.time()
+        self.loop.start(self.interval, now=False)
+        self.thread = threading.Thread(target=self.watch, name='reactor-watchdog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.loop.running: self.loop.stop()
+        self.thread = None
+
+    def tick(self):
+        ts = time.time()
+        metric_lag.observe(max(0, ts - self.last_tick - self.interval))
+        self.last_tick = ts
+        if self.stalled:
+            log.warning('Reactor was blocked for %.3fs', ts - self.stalled)
+            self.stalled = None
+
+    def sample(self):
+        frame = sys._current_frames().get(self.reactor_thread)
+        if frame is None: return None, None
+        code = frame.f_code
+        location = '{}:{} {}'.format(code.co_filename, frame.f_lineno, code.co_name)
+        return location, ''.join(traceback.format_stack(frame))
+
+    def watch(self):
+        while self.thread is not None:
+            time.sleep(self.interval)
+            last_tick = self.last_tick
+            if time.time() - last_tick < self.threshold: continue
+            location, stack = self.sample()
+            if location is None: continue
+            metric_samples.inc(location)
+            if self.stalled is None:
+                self.stalled = last_tick
+                metric_stalls.inc()
+                log.warning( 'Reactor blocked for more than'
+                    ' %.1fs, current stack:\n%s', self.threshold, stack.rstrip() )
+            else: log.debug('Reactor still blocked, current stack:\n%s', stack.rstrip())